@@ -2,11 +2,14 @@
 import sys
 import os
 import uuid
-from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,QDialog,QSpinBox, QPushButton,
+import time
+from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,QDialog,QSpinBox, QPushButton, QCheckBox,
                              QLabel, QTextEdit, QListWidget, QLineEdit, QFileDialog, QMessageBox,
-                             QInputDialog)
+                             QInputDialog, QProgressBar)
 from PyQt5.QtCore import Qt
-from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy
+from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, BINARY_LIBRARY_EXTENSION
+from progress import ProgressReporter, check_cancel
+from workers import JobWorker, progress_text
 
 
 class LibraryReformatterGUI(QWidget):
@@ -43,6 +46,12 @@ class LibraryReformatterGUI(QWidget):
         self.topnum_spinBox.setMaximum(15)
         self.topnum_spinBox.setValue(1)  # Default value
         layout.addWidget(self.topnum_spinBox)
+        
+        # Binary library output, memory-mapped by the identification for fast startup. Off by default: it loads the
+        # whole reformatted library into memory, the identification also creates it on the first load of the library
+        self.binary_checkbox = QCheckBox(f"Also save binary library ({BINARY_LIBRARY_EXTENSION}, loads the library into memory)")
+        self.binary_checkbox.setChecked(False)
+        layout.addWidget(self.binary_checkbox)
          
         # Log Area
         self.log_label = QLabel("Log:")
@@ -63,9 +72,21 @@ class LibraryReformatterGUI(QWidget):
         self.process_files_button = QPushButton('Process and Reformat Files')
         self.process_files_button.clicked.connect(self.process_files)
         button_layout.addWidget(self.process_files_button)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_processing)
+        button_layout.addWidget(self.cancel_button)
         
         layout.addLayout(button_layout)
         
+        # Streaming progress, the number of spectra is not known in advance
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1)
+        layout.addWidget(self.progress_bar)
+        self.progress_label = QLabel('')
+        layout.addWidget(self.progress_label)
+        self.worker = None
+        
         self.setLayout(layout)
         
         self.filepaths = []
@@ -95,6 +116,8 @@ class LibraryReformatterGUI(QWidget):
         self.log_area.append(message)
         
     def process_files(self):
+        if self.worker is not None and self.worker.isRunning():
+            return
         if not self.filepaths:
             QMessageBox.warning(self, "Error", "Please select one or more input files.")
             return
@@ -104,27 +127,76 @@ class LibraryReformatterGUI(QWidget):
 
         topnum = self.topnum_spinBox.value()
         self.log(f"Starting file processing with top {topnum} peaks in library mass spectra...")
-        # 这里添加文件处理逻辑
-        
-        try:
-            self.log("Combining libraries...")
-            combined_library = LibraryLoadingStrategy.combine_libraries(self.filepaths)
-            self.log("Libraries combined successfully.")
-
-            self.log(f"Reformatting library for top {topnum} peaks in library mass spectra...")
-            reformat = LibraryReformat(topnum)
-            reformatted_library = reformat.reformat_library(combined_library)
-            self.log("Library reformatted successfully.")
-
-            random_filename = f"reformatted_library_{uuid.uuid4()}.msp"
-            output_file_path = os.path.join(self.output_directory, random_filename)
-            self.log("Saving reformatted library...")
-            LibrarySaveStrategy.save_library_to_msp_class(reformatted_library, output_file_path)
-            self.log(f"Library saved successfully to {output_file_path}.")
-
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
-            self.log(f"An error occurred: {str(e)}")
+        filepaths = list(self.filepaths)
+        random_filename = f"reformatted_library_{uuid.uuid4()}.msp"
+        output_file_path = os.path.join(self.output_directory, random_filename)
+        save_binary = self.binary_checkbox.isChecked()
+
+        def job(progress_callback, cancel):
+            # libraries are streamed: combined, reformatted and written spectrum by spectrum
+            combined_library = LibraryLoadingStrategy.iter_combined_libraries(filepaths)
+            reformatted_library = LibraryReformat(topnum).iter_reformat_library(combined_library)
+            progress = ProgressReporter(progress_callback, label='Reformatting', unit='spectra')
+            start_time = time.perf_counter()
+
+            def report_progress(count):
+                check_cancel(cancel)
+                progress.update(count - progress.done)
+
+            try:
+                count = LibrarySaveStrategy.save_library_to_msp_class(reformatted_library, output_file_path,
+                                                                      progress_callback=report_progress,
+                                                                      progress_interval=1000)
+            except Exception:
+                if os.path.exists(output_file_path):
+                    os.remove(output_file_path)   # no partially written library
+                raise
+            progress.update(count - progress.done)
+            progress.finish()
+            elapsed = time.perf_counter() - start_time
+
+            binary_file_path = None
+            if save_binary:
+                check_cancel(cancel)
+                # re-read the written library into the columnar container instead of keeping it in memory while streaming
+                binary_file_path = output_file_path + BINARY_LIBRARY_EXTENSION
+                library = LibraryLoadingStrategy(output_file_path).load_spectral_library(use_cache=False)
+                LibrarySaveStrategy.save_library_to_binary(library, binary_file_path, source_path=output_file_path)
+            return count, elapsed, binary_file_path
+
+        self.worker = JobWorker(job, self)
+        self.worker.progress.connect(lambda info: self.progress_label.setText(progress_text(info)))
+        self.worker.succeeded.connect(lambda result: self.processing_succeeded(output_file_path, *result))
+        self.worker.failed.connect(self.processing_failed)
+        self.worker.cancelled.connect(lambda: self.log("Reformatting cancelled."))
+        self.worker.finished.connect(self.processing_finished)
+        self.process_files_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setRange(0, 0)   # busy indicator
+        self.log("Streaming libraries...")
+        self.worker.start()
+
+    def cancel_processing(self):
+        if self.worker is not None:
+            self.log("Cancelling...")
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+
+    def processing_succeeded(self, output_file_path, count, elapsed, binary_file_path):
+        self.log(f"Library saved successfully to {output_file_path}: {count} spectra in {elapsed:.1f} s "
+                 f"({count / max(elapsed, 1e-9):.0f} spectra/s).")
+        if binary_file_path:
+            self.log(f"Binary library saved successfully to {binary_file_path}.")
+
+    def processing_failed(self, message):
+        QMessageBox.critical(self, "Error", f"An error occurred: {message}")
+        self.log(f"An error occurred: {message}")
+
+    def processing_finished(self):
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(1)
+        self.process_files_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
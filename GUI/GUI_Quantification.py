@@ -1,8 +1,10 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QFileDialog, QLabel, QStatusBar, QFormLayout, QTextEdit
+from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QFileDialog, QLabel, QStatusBar, QFormLayout, QTextEdit, QProgressBar, QLineEdit, QCheckBox
 import os
 import pandas as pd
-from meta_quan_merge import Meta_df_Merge
+from meta_quan_merge import Meta_df_Merge, side_table_filename
+from quant_store import QuantStore
+from workers import JobWorker, progress_text
 
 
 
@@ -32,10 +34,32 @@ class Meta_Quantification_GUI(QWidget):
         self.output_folder_label = QLabel('Output Folder: Not selected', self)
         layout.addWidget(self.output_folder_label)
 
+        # Features aligned by m/z tolerance instead of the precursor rounded to 2 decimals, empty keeps the rounded labels
+        self.align_ppm_edit = QLineEdit(self)
+        self.align_ppm_edit.setPlaceholderText('empty: precursor rounded to 2 decimals')
+        self.formLayout.addRow('Feature alignment tolerance (ppm):', self.align_ppm_edit)
+        # Best identification per aligned feature with the intensity of every sample, in one tidy table
+        self.compound_checkbox = QCheckBox('Write compound table (merged_output_compounds.csv)', self)
+        self.formLayout.addRow(self.compound_checkbox)
+        layout.addLayout(self.formLayout)
+
         self.btn_process_files = QPushButton('Process Files in Folder', self)
         self.btn_process_files.clicked.connect(self.process_files)
         layout.addWidget(self.btn_process_files)
 
+        self.btn_cancel = QPushButton('Cancel', self)
+        self.btn_cancel.setEnabled(False)
+        self.btn_cancel.clicked.connect(self.cancel_processing)
+        layout.addWidget(self.btn_cancel)
+
+        # Progress over the result files of the input folder
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        layout.addWidget(self.progress_bar)
+        self.progress_label = QLabel('', self)
+        layout.addWidget(self.progress_label)
+        self.worker = None
+
         # Text edit for log messages
         self.log_window = QTextEdit(self)
         self.log_window.setReadOnly(True)
@@ -64,17 +88,65 @@ class Meta_Quantification_GUI(QWidget):
             self.log(f"Selected output folder: {folder}")
 
     def process_files(self):
+        if self.worker is not None and self.worker.isRunning():
+            return
         if hasattr(self, 'input_folder') and hasattr(self, 'output_folder'):
+            input_folder, output_folder = self.input_folder, self.output_folder
             try:
-                self.log("Starting file processing...")
-                processor = Meta_df_Merge(self.input_folder)
-                final_df = processor.merge_dfs()
-                message = processor.save_final_df(final_df, self.output_folder)
-                self.log("Process finished")
-            except Exception as e:
-                self.log(f"Error: {str(e)}")
+                align_ppm = float(self.align_ppm_edit.text()) if self.align_ppm_edit.text().strip() else None
+            except ValueError:
+                self.log("Feature alignment tolerance must be a number.")
+                return
+
+            compounds = self.compound_checkbox.isChecked()
+
+            def job(progress_callback, cancel):
+                n_workers = os.cpu_count() or 1
+                if align_ppm is not None or compounds:
+                    # the compound table needs aligned features, 10 ppm when no tolerance is given
+                    processor = Meta_df_Merge(input_folder)
+                    alignment = processor.align_features(align_ppm if align_ppm is not None else 10.0, identifications=compounds,
+                                                         progress_callback=progress_callback, cancel=cancel, n_workers=n_workers)
+                    processor.save_final_df(alignment.feature_table(), output_folder)
+                    processor.save_final_df(alignment.mapping, output_folder, side_table_filename('merged_output.csv', 'mapping'))
+                    if compounds:
+                        processor.save_final_df(alignment.compound_table(), output_folder,
+                                                side_table_filename('merged_output.csv', 'compounds'))
+                    return f"Process finished ({len(alignment)} aligned features)"
+                # only result files added or changed since the last merge of the folder are read
+                processor = QuantStore(input_folder)
+                final_df = processor.merge_dfs(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers)
+                processor.save_final_df(final_df, output_folder)
+                counts = processor.last_update
+                return f"Process finished ({counts['added']} new, {counts['changed']} changed, {counts['removed']} removed result files)"
+
+            self.log("Starting file processing...")
+            self.worker = JobWorker(job, self)
+            self.worker.progress.connect(self.show_progress)
+            self.worker.succeeded.connect(self.log)
+            self.worker.failed.connect(lambda message: self.log(f"Error: {message}"))
+            self.worker.cancelled.connect(lambda: self.log("Process cancelled"))
+            self.worker.finished.connect(self.processing_finished)
+            self.btn_process_files.setEnabled(False)
+            self.btn_cancel.setEnabled(True)
+            self.progress_bar.setValue(0)
+            self.worker.start()
         else:
-            self.status_bar.showMessage("Please select both input and output folders.")
+            self.log("Please select both input and output folders.")
+
+    def show_progress(self, info):
+        if info['percent'] is not None:
+            self.progress_bar.setValue(int(info['percent']))
+        self.progress_label.setText(progress_text(info))
+
+    def cancel_processing(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.btn_cancel.setEnabled(False)
+
+    def processing_finished(self):
+        self.btn_process_files.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
             
 
 # if __name__ == '__main__':
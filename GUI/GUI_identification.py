@@ -4,12 +4,13 @@ import os
 import uuid
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QDialog, QSpinBox, QPushButton, QCheckBox,
                              QLabel, QTextEdit, QListWidget, QLineEdit, QFileDialog, QMessageBox,QMainWindow, QTabWidget,QFormLayout,
-                             QInputDialog)
-from PyQt5.QtCore import Qt
+                             QInputDialog, QComboBox, QProgressBar)
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
 from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path
-from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
+from IdentificationMeta import QueryTargetedSpectrum, QueryPreprocessing, LibraryIndex, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
 
-from querylibrarymatch import get_spectra, match_and_calculate_cosine_similarity, main_processing_function, generate_plot, save_results
+from workers import JobWorker, progress_text
+from querylibrarymatch import get_spectra, match_and_calculate_cosine_similarity, main_processing_function, generate_plot, save_results, run_identification
 import pandas as pd
 
 import os
@@ -19,15 +20,20 @@ import heapq
 import logging
 from collections import defaultdict
 
-class QTextEditLogger(logging.Handler, object):
+class QTextEditLogger(logging.Handler, QObject):
+    # records may come from worker threads, the text is appended on the GUI thread through a queued signal
+    appendText = pyqtSignal(str)
+
     def __init__(self, widget):
-        super(QTextEditLogger, self).__init__()
+        logging.Handler.__init__(self)
+        QObject.__init__(self)
         self.widget = widget
         self.widget.setReadOnly(True)
+        self.appendText.connect(self.widget.append)
     
     def emit(self, record):
         msg = self.format(record)
-        self.widget.append(msg)
+        self.appendText.emit(msg)
 
 class StreamToLogger(object):
     """
@@ -139,6 +145,59 @@ class Identification_GUI(QWidget):
         self.generatePlotsCheckbox.setChecked(False)  # Default is unchecked (no plots generated)
         self.formLayout.addRow(self.generatePlotsCheckbox)
         
+        # Plots are rendered in background processes, optionally limited to the best hits per compound
+        self.plotFormatCombo = QComboBox()
+        self.plotFormatCombo.addItems(['svg', 'png', 'pdf'])
+        self.formLayout.addRow('Plot Format (pdf: one file per input):', self.plotFormatCombo)
+        self.plotTopNSpin = QSpinBox()
+        self.plotTopNSpin.setMinimum(0)
+        self.plotTopNSpin.setMaximum(10000)
+        self.plotTopNSpin.setValue(0)
+        self.plotTopNSpin.setSpecialValueText('All')
+        self.formLayout.addRow('Plots per Compound (top N):', self.plotTopNSpin)
+        self.plotMinScoreEdit = QLineEdit()
+        self.formLayout.addRow('Min Plot Cosine Score:', self.plotMinScoreEdit)
+        
+        # Number of worker processes, scan ranges are split into chunks and identified in parallel when above 1
+        self.workersSpin = QSpinBox()
+        self.workersSpin.setMinimum(1)
+        self.workersSpin.setMaximum(os.cpu_count() or 1)
+        self.workersSpin.setValue(1)
+        self.formLayout.addRow('Worker Processes:', self.workersSpin)
+        
+        # Replicate scans of the same window (precursor, CV) can be merged and identified once
+        self.aggregateCombo = QComboBox()
+        self.aggregateCombo.addItems(['None', 'Sum', 'Mean'])
+        self.formLayout.addRow('Scan Aggregation:', self.aggregateCombo)
+        
+        # Results are streamed to csv/parquet while scans are processed, Excel is an optional extra copy
+        self.outputFormatCombo = QComboBox()
+        self.outputFormatCombo.addItems(['csv', 'parquet', 'xlsx'])
+        self.formLayout.addRow('Result Format:', self.outputFormatCombo)
+        self.excelExportCheckbox = QCheckBox('Also Export Excel (.xlsx)')
+        self.excelExportCheckbox.setChecked(False)
+        self.formLayout.addRow(self.excelExportCheckbox)
+        
+        # Progress is recorded in the output folder, a restarted batch skips finished files and resumes unfinished ones
+        self.resumeCheckbox = QCheckBox('Resume Interrupted Runs (checkpoints)')
+        self.resumeCheckbox.setChecked(False)
+        self.formLayout.addRow(self.resumeCheckbox)
+        
+        # Optional preprocessing of the query spectra, fewer and cleaner peaks go into matching
+        self.centroidCheckbox = QCheckBox('Centroid Profile Spectra')
+        self.centroidCheckbox.setChecked(False)
+        self.formLayout.addRow(self.centroidCheckbox)
+        self.snrEdit = QLineEdit()
+        self.formLayout.addRow('Min Signal/Noise (x median):', self.snrEdit)
+        self.relativeThresholdEdit = QLineEdit()
+        self.formLayout.addRow('Min Relative Intensity (0~1):', self.relativeThresholdEdit)
+        self.topNSpin = QSpinBox()
+        self.topNSpin.setMinimum(0)
+        self.topNSpin.setMaximum(10000)
+        self.topNSpin.setValue(0)
+        self.topNSpin.setSpecialValueText('All')
+        self.formLayout.addRow('Peaks per 100 m/z (top N):', self.topNSpin)
+        
         layout.addLayout(self.formLayout)
         
         # Add the Clear button to the layout
@@ -148,6 +207,18 @@ class Identification_GUI(QWidget):
         self.startBtn = QPushButton('Start Analysis',self)
         self.startBtn.clicked.connect(self.startAnalysis)
         layout.addWidget(self.startBtn)
+        self.cancelBtn = QPushButton('Cancel', self)
+        self.cancelBtn.setEnabled(False)
+        self.cancelBtn.clicked.connect(self.cancelAnalysis)
+        layout.addWidget(self.cancelBtn)
+        
+        # Progress of the current input file: percent, scans/s and ETA
+        self.progressBar = QProgressBar()
+        self.progressBar.setRange(0, 100)
+        layout.addWidget(self.progressBar)
+        self.progressLabel = QLabel('')
+        layout.addWidget(self.progressLabel)
+        self.worker = None
         
         #  logging displaying area...
         self.logTextEdit = QTextEdit()  # Log display area
@@ -209,12 +280,15 @@ class Identification_GUI(QWidget):
     
     def startAnalysis(self):
         
+        if self.worker is not None and self.worker.isRunning():
+            return
         logging.info("Analysis started.")
         
         try: 
             
-            library_loader = LibraryLoadingStrategy(self.libraryFilePath)
-            library = library_loader.load_library()
+            library_path = self.libraryFilePath
+            input_paths = list(self.InputFilePaths)
+            fig_path = self.figPath
             ppm_tolerance = float(self.ppmToleranceEdit.text())
             minmatchedpeaks = int(self.minMatchedPeaksEdit.text())
             PrecursorIonMassTolerance = float(self.precursorIonMassToleranceEdit.text())
@@ -225,34 +299,77 @@ class Identification_GUI(QWidget):
             # Retrieve the state of the generate plots checkbox
         
             generate_plots = self.generatePlotsCheckbox.isChecked()
+            n_workers = self.workersSpin.value()
+            plot_workers = 1
+            if generate_plots:   # the worker processes are shared between identification and the plot queue
+                plot_workers = max(1, n_workers // 2)
+                n_workers = max(1, n_workers - plot_workers)
+            plot_format = self.plotFormatCombo.currentText()
+            plot_top_n = self.plotTopNSpin.value() or None
+            plot_min_score = float(self.plotMinScoreEdit.text()) if self.plotMinScoreEdit.text().strip() else None
+            output_format = self.outputFormatCombo.currentText()
+            excel_export = self.excelExportCheckbox.isChecked()
+            checkpoint = self.resumeCheckbox.isChecked()
+            aggregate = None if self.aggregateCombo.currentText() == 'None' else self.aggregateCombo.currentText().lower()
+            snr = float(self.snrEdit.text()) if self.snrEdit.text().strip() else None
+            relative_threshold = float(self.relativeThresholdEdit.text()) if self.relativeThresholdEdit.text().strip() else None
+            top_n = self.topNSpin.value() or None
+            preprocessing = None
+            if self.centroidCheckbox.isChecked() or snr is not None or relative_threshold is not None or top_n is not None:
+                preprocessing = QueryPreprocessing(centroid=self.centroidCheckbox.isChecked(), snr=snr,
+                                                   relative_threshold=relative_threshold, top_n=top_n)
          # set it to Default scans in the input file if nothing is set
+            if higherscan == 1:
+                higherscan = None
+        except Exception as e:
+            logging.error(f"An error occurred: {str(e)}")
+            return
 
-            for InputFilePath in self.InputFilePaths:
+        def job(progress_callback, cancel):
+            library_loader = LibraryLoadingStrategy(library_path)
+            library = LibraryIndex(library_loader.load_spectral_library())  # sorted precursor index, built once for all input files
+            return run_identification(input_paths, library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                                      minmatchedpeaks, fig_path, intensity_threshold=intensity_threshold,
+                                      lowerscan=lowerscan, higherscan=higherscan, generate_plots=generate_plots,
+                                      n_workers=n_workers, aggregate=aggregate, output_format=output_format,
+                                      excel_export=excel_export, checkpoint=checkpoint, plot_format=plot_format,
+                                      plot_top_n=plot_top_n, plot_min_score=plot_min_score, plot_workers=plot_workers,
+                                      preprocessing=preprocessing, progress_callback=progress_callback, cancel=cancel)
 
+        # the run goes on in a worker thread, the window stays responsive and shows the progress
+        self.worker = JobWorker(job, self)
+        self.worker.progress.connect(self.showProgress)
+        self.worker.succeeded.connect(self.analysisSucceeded)
+        self.worker.failed.connect(lambda message: logging.error(f"An error occurred: {message}"))
+        self.worker.cancelled.connect(lambda: logging.info("Analysis cancelled."))
+        self.worker.finished.connect(self.analysisFinished)
+        self.startBtn.setEnabled(False)
+        self.cancelBtn.setEnabled(True)
+        self.progressBar.setValue(0)
+        self.worker.start()
 
-                analyzer = QueryTargetedSpectrum(InputFilePath,intensity_threshold)
+    def showProgress(self, info):
+        if info['percent'] is not None:
+            self.progressBar.setValue(int(info['percent']))
+        self.progressLabel.setText(progress_text(info))
 
-                if higherscan == 1:
-                      # Adjust based on your implementation
-                    total_scans = analyzer.get_scans()     
-                    higherscan = total_scans 
+    def analysisSucceeded(self, results):
+        # with checkpoints a failing input file is recorded as None and the batch goes on with the next one
+        failed = [path for path, result in results.items() if result is None]
+        if failed:
+            logging.error(f"{len(failed)} of {len(results)} files failed: {', '.join(failed)}")
+        else:
+            logging.info("Analysis completed successfully.")
 
-                 # Get the number of scans from the input field
+    def cancelAnalysis(self):
+        if self.worker is not None:
+            logging.info("Cancelling analysis...")
+            self.worker.cancel()
+            self.cancelBtn.setEnabled(False)
 
-                result_dicts = main_processing_function(lowerscan, higherscan, analyzer, library, PrecursorIonMassTolerance,
-                                                        cosine_threshold,ppm_tolerance, minmatchedpeaks, self.figPath, 
-                                                        generate_plots = generate_plots
-                                                       )
-            
-                # higherscan = self.scansUpperSpin.value() 
-            
-                save_results(result_dicts, self.figPath, InputFilePath)
-            
-            logging.info("Analysis completed successfully.")
-            
-        except Exception as e:
-            
-            logging.error(f"An error occurred: {str(e)}")
+    def analysisFinished(self):
+        self.startBtn.setEnabled(True)
+        self.cancelBtn.setEnabled(False)
             
 
 # def main():
@@ -0,0 +1,47 @@
+import traceback
+from PyQt5.QtCore import QThread, pyqtSignal
+from progress import RunCancelled, format_progress
+
+
+class JobWorker(QThread):
+    """
+    Runs a long job off the Qt main thread.
+    job is called as job(progress_callback, cancel): progress_callback forwards ProgressReporter dicts to the
+    progress signal, cancel returns True once cancel() was requested and the job should stop (with RunCancelled).
+    Exactly one of succeeded(result), failed(message) or cancelled() is emitted when the job ends.
+    """
+
+    progress = pyqtSignal(dict)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, job, parent=None):
+        super().__init__(parent)
+        self.job = job
+        self._cancel_requested = False
+
+    def cancel(self):
+        self._cancel_requested = True
+
+    def is_cancel_requested(self) -> bool:
+        return self._cancel_requested
+
+    def run(self):
+        try:
+            result = self.job(self.progress.emit, self.is_cancel_requested)
+        except RunCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(result)
+
+
+def progress_text(info) -> str:
+    """status line of a progress dict, with the file position when the job runs over several files"""
+    text = format_progress(info)
+    if 'n_files' in info:
+        text = f"File {info['file_index'] + 1}/{info['n_files']} - " + text
+    return text
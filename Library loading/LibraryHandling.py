@@ -1,20 +1,25 @@
 
 
-from pyteomics import mgf
 import os
-from pyteomics import mzml
-import pyteomics
-import matplotlib.pyplot as plt
-import pandas as pd
-import glob
 import heapq
+import sys
+import json
+from array import array
+from collections.abc import Mapping
+import numpy as np
+
+
+BINARY_LIBRARY_EXTENSION = '.dimlib'
+BINARY_LIBRARY_MAGIC = b'DIMETALIB1\n'
 
 
 class LibraryLoadingStrategy:
     
-    '''class for loading Libraries'''
-    def __init__(self, file_path):
+    '''class for loading Libraries,
+    msp_parser selects the .msp backend: 'fast' parses peak blocks in bulk, 'python' is the line by line reference parser'''
+    def __init__(self, file_path, msp_parser='fast'):
         self.file_path = file_path
+        self.msp_parser = msp_parser
 
     def load_library(self):
         """Automatically load library based on file extension."""
@@ -23,20 +28,40 @@ class LibraryLoadingStrategy:
             return self._load_mgf()
         elif file_extension.lower() == '.msp':
             return self._load_msp()
+        elif file_extension.lower() == BINARY_LIBRARY_EXTENSION:
+            return self._load_binary()
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
 
     def _load_mgf(self)-> list:
         """Load a library from a .mgf file."""
+        from pyteomics import mgf
         # Assuming mgf.IndexedMGF is a class from an external library
         spectra_library = mgf.IndexedMGF(self.file_path, index_by_scans=True)
         return spectra_library
 
     def _load_msp(self)-> list:
-        """Load a library from a .msp file."""
-        
+        """Load a library from a .msp file with the parser selected by msp_parser."""
+        return list(self.iter_library())
+
+    def iter_library(self):
+        """
+        Yield the spectra of the library one at a time as dicts in the .msp layout
+        (lowercase metadata strings plus 'mz' and 'intensity' lists), so large libraries are processed in constant memory.
+        .mgf spectra are converted to the same layout: TITLE becomes name and PEPMASS becomes precursormz.
+        """
+        _, file_extension = os.path.splitext(self.file_path)
+        if file_extension.lower() == '.mgf':
+            return self._iter_mgf()
+        elif file_extension.lower() == '.msp':
+            return self._iter_msp_fast() if self.msp_parser == 'fast' else self._iter_msp()
+        elif file_extension.lower() == BINARY_LIBRARY_EXTENSION:
+            return (dict(entry) for entry in self._load_binary())
+        else:
+            raise ValueError(f"Unsupported file format: {file_extension}")
+
+    def _iter_msp(self):
         with open(self.file_path, 'r', encoding='utf-8') as file:
-            spectra = []
             spectrum = {} # Start with an empty dictionary
             for line in file:
                 line = line.strip().lower() # remove leading and trailing whitespace characters, format uppercase to lowercase
@@ -44,7 +69,7 @@ class LibraryLoadingStrategy:
                     continue
                 if line.startswith('name:'):   
                     if 'mz' in spectrum:         # Check if the current spectrum already has 'mz' key
-                        spectra.append(spectrum)
+                        yield spectrum
                         spectrum = {}            # Reset for new spectrum
                 if ':' in line:                 # Meta data line
                     key, value = line.split(':', 1)
@@ -53,18 +78,263 @@ class LibraryLoadingStrategy:
                     mz, intensity = line.split()
                     spectrum.setdefault('mz', []).append(float(mz))
                     spectrum.setdefault('intensity', []).append(float(intensity))
-            if 'mz' in spectrum:       # append the last spectrum
-                spectra.append(spectrum)
-            return spectra
+            if 'mz' in spectrum:       # yield the last spectrum
+                yield spectrum
+
+    def _iter_msp_fast(self, chunk_size=1 << 22):
+        """
+        Same output as _iter_msp. The file is read in large chunks and only metadata lines (the ones containing ':')
+        go through strip/lower/split in Python, the peak lines of a whole chunk are converted to numbers with one np.loadtxt call.
+        """
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            spectrum = {} # Start with an empty dictionary
+            while True:
+                text = file.read(chunk_size)
+                if not text:
+                    break
+                text += file.readline()   # complete the last line of the chunk
+                lines = list(filter(None, text.split('\n')))   # drop empty lines
+                metadata_rows = [row for row, line in enumerate(lines) if ':' in line]
+                metadata_rows.append(len(lines))
+
+                completed = []            # spectra finished in this chunk, yielded once their peaks are filled in
+                blocks = []               # (spectrum, first row, end row) of consecutive peak lines
+                if metadata_rows[0] > 0:
+                    self._add_peak_block(spectrum, 0, metadata_rows[0], blocks, lines)
+                for row, next_row in zip(metadata_rows, metadata_rows[1:]):
+                    line = lines[row].strip().lower()
+                    if line.startswith('name:') and 'mz' in spectrum:
+                        completed.append(spectrum)
+                        spectrum = {}     # Reset for new spectrum
+                    key, value = line.split(':', 1)
+                    spectrum[key.strip()] = value.strip()
+                    if next_row > row + 1:
+                        self._add_peak_block(spectrum, row + 1, next_row, blocks, lines)
+                self._fill_peaks(lines, blocks)
+                yield from completed
+            if 'mz' in spectrum:       # yield the last spectrum
+                yield spectrum
+
+    @staticmethod
+    def _add_peak_block(spectrum, first, end, blocks, lines):
+        if not any(line.strip() for line in lines[first:end]):
+            return   # whitespace only, skipped like the blank lines of _iter_msp
+        if 'mz' not in spectrum:
+            spectrum['mz'], spectrum['intensity'] = [], []
+        blocks.append((spectrum, first, end))
+
+    @staticmethod
+    def _fill_peaks(lines, blocks):
+        """parse the peak lines of a chunk in bulk, text that is not clean 'mz intensity' pairs takes the line by line path"""
+        peak_lines = [line for spectrum, first, end in blocks for line in lines[first:end]]
+        if not peak_lines:
+            return
+        try:
+            values = np.loadtxt(peak_lines, dtype=np.float64, comments=None, ndmin=2)   # rejects lines that are not two numbers
+        except ValueError:
+            values = None
+        if values is not None and values.shape == (len(peak_lines), 2):
+            mzs, intensities = values[:, 0].tolist(), values[:, 1].tolist()
+            offset = 0
+            for spectrum, first, end in blocks:
+                spectrum['mz'].extend(mzs[offset:offset + end - first])
+                spectrum['intensity'].extend(intensities[offset:offset + end - first])
+                offset += end - first
+            return
+        for spectrum, first, end in blocks:   # blank-looking lines or malformed peaks
+            for line in lines[first:end]:
+                if line.strip():
+                    mz, intensity = line.split()
+                    spectrum['mz'].append(float(mz))
+                    spectrum['intensity'].append(float(intensity))
+
+    def _iter_mgf(self):
+        from pyteomics import mgf
+        with mgf.read(self.file_path, use_index=False) as reader:
+            for record in reader:
+                spectrum = {}
+                for key, value in record['params'].items():
+                    key = {'title': 'name', 'pepmass': 'precursormz'}.get(key.lower(), key.lower())
+                    if key == 'precursormz':
+                        value = value[0]   # (m/z, intensity) pair
+                    elif isinstance(value, (list, tuple)):
+                        value = ' '.join(str(item) for item in value)
+                    spectrum.setdefault(key, str(value).strip().lower())
+                if len(record['m/z array']):
+                    spectrum['mz'] = [float(mz) for mz in record['m/z array']]
+                    spectrum['intensity'] = [float(intensity) for intensity in record['intensity array']]
+                    yield spectrum
     
+    def _load_binary(self) -> 'SpectralLibrary':
+        """Load a binary library, the numeric arrays are memory-mapped from the file."""
+        return SpectralLibrary.from_binary(self.file_path)
+
+    def load_spectral_library(self, use_cache=True) -> 'SpectralLibrary':
+        """
+        Load the library into the compact array-backed SpectralLibrary container.
+        With use_cache a binary copy is kept next to a text library (<library>.dimlib) and memory-mapped on the next load,
+        as long as the size and modification time of the text library are unchanged.
+        """
+        _, file_extension = os.path.splitext(self.file_path)
+        if file_extension.lower() == BINARY_LIBRARY_EXTENSION:
+            return self._load_binary()
+
+        cache_path = self.file_path + BINARY_LIBRARY_EXTENSION
+        if use_cache and os.path.exists(cache_path):
+            try:
+                header = SpectralLibrary.read_binary_header(cache_path)
+                if header.get('source') == source_fingerprint(self.file_path):
+                    return SpectralLibrary.from_binary(cache_path, header=header)   # the header is parsed once
+            except (OSError, ValueError):
+                pass   # unreadable cache, parse the text library again
+
+        library = SpectralLibrary.from_spectra(self.iter_library())
+        if use_cache:
+            try:
+                LibrarySaveStrategy.save_library_to_binary(library, cache_path, source_path=self.file_path)
+                library = SpectralLibrary.from_binary(cache_path)
+            except OSError:
+                pass   # e.g. read-only library folder, keep the in-memory library
+        return library
+
     @classmethod
     def combine_libraries(cls, file_paths) -> list:
         """Combine all spectrums in all input libraries from the provided file paths into a new library."""
-        combined_library = []
+        return list(cls.iter_combined_libraries(file_paths))
+
+    @classmethod
+    def iter_combined_libraries(cls, file_paths):
+        """Stream the spectra of all input libraries one after another, see iter_library."""
         for file_path in file_paths:
-            loader = cls(file_path)
-            combined_library.extend(loader.load_library())
-        return combined_library
+            yield from cls(file_path).iter_library()
+
+class SpectralLibrary:
+    
+    '''Compact, array-backed library: the peaks of all spectra are concatenated into flat m/z and intensity arrays
+    with per spectrum offsets, precursor m/z is parsed once into a float64 column, names, adducts and formulas are
+    interned string columns and the remaining metadata is kept per spectrum.
+    Indexing returns a read-only dict-like LibraryEntry, so code written for the list of dicts keeps working.'''
+    
+    string_columns = ('name', 'precursortype', 'formula')
+
+    def __init__(self, mz, intensity, offsets, precursor_mz, strings, metadata, precursor_order=None):
+        self.mz = mz
+        self.intensity = intensity
+        self.offsets = offsets
+        self.precursor_mz = precursor_mz
+        self.strings = strings
+        self.metadata = metadata
+        self.precursor_order = precursor_order   # argsort of precursor_mz when known, e.g. stored in a binary library
+
+    @classmethod
+    def from_spectra(cls, spectra) -> 'SpectralLibrary':
+        """Build the container from an iterable of spectrum dicts as produced by LibraryLoadingStrategy."""
+        mz, intensity, offsets, precursor_mz = array('d'), array('d'), array('q', [0]), array('d')
+        strings = {column: [] for column in cls.string_columns}
+        metadata = []
+        for spectrum in spectra:
+            mz.extend(spectrum.get('mz', []))
+            intensity.extend(spectrum.get('intensity', []))
+            offsets.append(len(mz))
+            try:
+                precursor_mz.append(float(spectrum['precursormz']))
+            except (KeyError, ValueError):
+                precursor_mz.append(float('nan'))
+            for column in cls.string_columns:
+                value = spectrum.get(column)
+                strings[column].append(sys.intern(value) if isinstance(value, str) else value)
+            metadata.append({sys.intern(key): value for key, value in spectrum.items()
+                             if key not in ('mz', 'intensity') and key not in strings})
+        return cls(np.frombuffer(mz, dtype=np.float64), np.frombuffer(intensity, dtype=np.float64),
+                   np.frombuffer(offsets, dtype=np.int64), np.frombuffer(precursor_mz, dtype=np.float64),
+                   strings, metadata)
+
+    @staticmethod
+    def read_binary_header(file_path) -> dict:
+        """JSON header of a binary library file, see LibrarySaveStrategy.save_library_to_binary for the layout"""
+        with open(file_path, 'rb') as file:
+            if file.read(len(BINARY_LIBRARY_MAGIC)) != BINARY_LIBRARY_MAGIC:
+                raise ValueError(f"Not a binary library file: {file_path}")
+            header_size = int.from_bytes(file.read(8), 'little')
+            return json.loads(file.read(header_size).decode('utf-8'))
+
+    @classmethod
+    def from_binary(cls, file_path, header=None) -> 'SpectralLibrary':
+        """Open a binary library file, numeric arrays are read-only memory-mapped views of the file.
+        header is the result of read_binary_header when the caller has already read it."""
+        if header is None:
+            header = cls.read_binary_header(file_path)
+        raw = np.memmap(file_path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            arrays[name] = raw[spec['offset']:spec['offset'] + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+        strings = {column: [sys.intern(value) if value is not None else None for value in values]
+                   for column, values in header['strings'].items()}
+        return cls(arrays['mz'], arrays['intensity'], arrays['offsets'], arrays['precursor_mz'],
+                   strings, header['metadata'], precursor_order=arrays['precursor_order'])
+
+    def __len__(self):
+        return len(self.precursor_mz)
+
+    def __getitem__(self, i) -> 'LibraryEntry':
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('library index out of range')
+        return LibraryEntry(self, i)
+
+    def __iter__(self):
+        return (LibraryEntry(self, i) for i in range(len(self)))
+
+    def peaks(self, i) -> tuple:
+        """m/z and intensity arrays of spectrum i, views into the flat peak arrays"""
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:stop], self.intensity[start:stop]
+
+    def peak_spectrum(self) -> np.ndarray:
+        """index of the spectrum every peak of the flat peak arrays belongs to"""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+
+class LibraryEntry(Mapping):
+    
+    '''Read-only dict-like view of one spectrum of a SpectralLibrary.'''
+    
+    __slots__ = ('library', 'index')
+
+    def __init__(self, library, index):
+        self.library = library
+        self.index = index
+
+    def __getitem__(self, key):
+        library, i = self.library, self.index
+        if key == 'mz':
+            return library.peaks(i)[0]
+        if key == 'intensity':
+            return library.peaks(i)[1]
+        if key in library.strings:
+            value = library.strings[key][i]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return library.metadata[i][key]
+
+    def __iter__(self):
+        library, i = self.library, self.index
+        for column in library.string_columns:
+            if library.strings[column][i] is not None:
+                yield column
+        yield from library.metadata[i]
+        yield 'mz'
+        yield 'intensity'
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self) -> dict:
+        return dict(self)
 
 
 class LibraryReformat:
@@ -88,22 +358,79 @@ class LibraryReformat:
         return new_spectrum
 
     def reformat_library(self, library):
+        return list(self.iter_reformat_library(library))
 
-        reformatted_library = []
+    def iter_reformat_library(self, library):
+        """reformat the spectra of an iterable library lazily, one spectrum at a time"""
         for spectrum in library:
+            if not isinstance(spectrum, dict):   # read-only LibraryEntry of a SpectralLibrary
+                spectrum = dict(spectrum)
             if 'precursor_type' in spectrum:
                 spectrum['precursortype'] = spectrum.pop('precursor_type')
             if 'precursormz' in spectrum:
-                reformatted_library.append(self.reformat_spectrum(spectrum))
-        return reformatted_library
+                yield self.reformat_spectrum(spectrum)
     
 class LibrarySaveStrategy:
 
     @classmethod
-    def save_library_to_msp_class(cls, library, output_file_path):
-        """Save the library to a new .msp file using a class method."""
+    def save_library_to_binary(cls, library, output_file_path, source_path=None):
+        """
+        Save the library to a single binary file that SpectralLibrary.from_binary memory-maps:
+        magic, 8-byte little-endian header size, JSON header (array layout, string columns, metadata and
+        the size/mtime of source_path), then the numeric arrays aligned to 64 bytes.
+        The file is written under a temporary name and moved into place when complete.
+        """
+        if not isinstance(library, SpectralLibrary):
+            library = SpectralLibrary.from_spectra(library)
+        arrays = {'mz': np.ascontiguousarray(library.mz, dtype=np.float64),
+                  'intensity': np.ascontiguousarray(library.intensity, dtype=np.float64),
+                  'offsets': np.ascontiguousarray(library.offsets, dtype=np.int64),
+                  'precursor_mz': np.ascontiguousarray(library.precursor_mz, dtype=np.float64),
+                  'precursor_order': np.argsort(library.precursor_mz, kind='stable').astype(np.int64)}
+
+        layout, position, relative_offsets = {}, 0, {}
+        for name, values in arrays.items():
+            layout[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': 0}
+            relative_offsets[name] = position
+            position += -(-values.nbytes // 64) * 64
+        header = {'version': 1,
+                  'source': source_fingerprint(source_path) if source_path else None,
+                  'arrays': layout,
+                  'strings': library.strings,
+                  'metadata': library.metadata}
+
+        # the data block starts after the header, whose size depends on the offsets written into it
+        data_start = 0
+        while True:
+            for name, spec in layout.items():
+                spec['offset'] = data_start + relative_offsets[name]
+            header_bytes = json.dumps(header).encode('utf-8')
+            required_start = -(-(len(BINARY_LIBRARY_MAGIC) + 8 + len(header_bytes)) // 64) * 64
+            if required_start <= data_start:
+                break
+            data_start = required_start
+
+        tmp_path = output_file_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(BINARY_LIBRARY_MAGIC)
+            file.write(len(header_bytes).to_bytes(8, 'little'))
+            file.write(header_bytes)
+            for name, values in arrays.items():
+                file.seek(layout[name]['offset'])
+                file.write(values.tobytes())
+        os.replace(tmp_path, output_file_path)
+
+    @classmethod
+    def save_library_to_msp_class(cls, library, output_file_path, progress_callback=None, progress_interval=10000) -> int:
+        """
+        Save the library to a new .msp file using a class method.
+        The library can be any iterable of spectra, e.g. a generator from iter_library, it is written as it is consumed.
+        progress_callback(number of spectra written) is called every progress_interval spectra.
+        Returns the number of spectra written.
+        """
+        count = 0
         with open(output_file_path, 'w', encoding='utf-8') as file:
-            for spectrum in library:
+            for count, spectrum in enumerate(library, 1):
                 for key, value in spectrum.items():
                     if key not in ['mz', 'intensity']:
                         file.write(f"{key.capitalize()}: {value}\n")
@@ -113,6 +440,14 @@ class LibrarySaveStrategy:
                     file.write(f"{mz} {intensity}\n")
 
                 file.write("\n")    
+                if progress_callback is not None and count % progress_interval == 0:
+                    progress_callback(count)
+        return count
+
+def source_fingerprint(file_path) -> dict:
+    """size and modification time of a file, used to invalidate binary library caches"""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
 
 def read_path(dir)-> list:
     return([os.path.join(dir, file) for file in os.listdir(dir)])
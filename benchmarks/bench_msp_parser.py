@@ -0,0 +1,73 @@
+"""
+Parse-throughput benchmark of the .msp parsers of LibraryLoadingStrategy.
+
+Runs the line by line reference parser ('python') and the bulk peak-block parser ('fast') on the same library,
+checks that both produce the same spectra and reports spectra/s and MB/s.
+Without a library path a synthetic library is written to a temporary file.
+
+    python benchmarks/bench_msp_parser.py [library.msp] [--spectra 100000] [--peaks 20] [--repeat 3]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Library loading'))
+from LibraryHandling import LibraryLoadingStrategy
+
+
+def write_synthetic_msp(file_path, n_spectra, n_peaks, seed=0):
+    """write a deterministic .msp library with n_spectra spectra of up to n_peaks peaks"""
+    rng = random.Random(seed)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        for i in range(n_spectra):
+            precursor = rng.uniform(60, 900)
+            peaks = sorted(rng.uniform(40, precursor) for _ in range(rng.randint(1, n_peaks)))
+            file.write(f"Name: Compound_{i}\nPrecursorMZ: {precursor:.4f}\nPrecursor_type: [M+H]+\n"
+                       f"Formula: C{rng.randint(1, 40)}H{rng.randint(1, 80)}O{rng.randint(0, 20)}\nNum Peaks: {len(peaks)}\n")
+            for mz in peaks:
+                file.write(f"{mz:.4f} {rng.uniform(1, 1000):.2f}\n")
+            file.write("\n")
+
+
+def time_parser(file_path, msp_parser, repeat):
+    """best wall time of repeat full parses, and the parsed spectra of the last run"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        spectra = list(LibraryLoadingStrategy(file_path, msp_parser=msp_parser).iter_library())
+        best = min(best, time.perf_counter() - start)
+    return best, spectra
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('library', nargs='?', help='.msp library, a synthetic one is generated when omitted')
+    parser.add_argument('--spectra', type=int, default=100000)
+    parser.add_argument('--peaks', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = args.library
+        if file_path is None:
+            file_path = os.path.join(tmp_dir, 'synthetic.msp')
+            write_synthetic_msp(file_path, args.spectra, args.peaks)
+        size_mb = os.path.getsize(file_path) / 1e6
+
+        results = {}
+        for msp_parser in ('python', 'fast'):
+            results[msp_parser] = time_parser(file_path, msp_parser, args.repeat)
+            seconds, spectra = results[msp_parser]
+            print(f"{msp_parser:>7}: {seconds:8.3f} s  {len(spectra) / seconds:12.0f} spectra/s  {size_mb / seconds:8.1f} MB/s")
+
+        if results['python'][1] != results['fast'][1]:
+            sys.exit('parsers returned different libraries')
+        print(f"speedup: {results['python'][0] / results['fast'][0]:.2f}x, outputs identical")
+
+
+if __name__ == '__main__':
+    main()
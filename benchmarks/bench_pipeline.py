@@ -0,0 +1,228 @@
+"""
+Timing and peak-memory benchmark of the DImeta pipeline stages on deterministic synthetic data (see synthetic.py).
+
+Stages:
+    load_msp          parse the .msp library (LibraryLoadingStrategy._load_msp)
+    get_realtime_lib  candidate library spectra and target peaks of every MS2 scan, candidate cache disabled
+    match_spectrum    match the query peaks of every MS2 scan against its target peaks
+    score             cosine scores of the matches of every MS2 scan (score_candidates)
+    merge_dfs         quantification merge of synthetic result files (Meta_df_Merge.merge_dfs)
+    end_to_end        load the library, identify the run and merge the result (run_identification + merge_dfs)
+
+Each stage is timed repeat times (best and median wall time are reported) and run once more under tracemalloc for
+its peak Python memory; with --workers > 1 the end to end memory only covers the main process.
+--save-baseline writes the results as JSON, --compare checks them against such a file and exits with 1 when a stage
+is slower or needs more memory than the baseline by more than --tolerance (a fraction, default 0.2).
+
+    python benchmarks/bench_pipeline.py [--scans 2000] [--library-size 20000] [--format mzML] [--stages load_msp score]
+                                        [--save-baseline baseline.json] [--compare baseline.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(_ROOT, 'Library loading'))
+sys.path.insert(0, os.path.join(_ROOT, 'identification'))
+from LibraryHandling import LibraryLoadingStrategy
+from IdentificationMeta import QueryTargetedSpectrum, LibraryIndex, CandidateCache, match_spectrum, score_candidates
+from querylibrarymatch import run_identification
+from meta_quan_merge import Meta_df_Merge
+
+import synthetic
+
+
+STAGES = ('load_msp', 'get_realtime_lib', 'match_spectrum', 'score', 'merge_dfs', 'end_to_end')
+
+
+def measure(function, repeat) -> dict:
+    """best and median wall time of repeat calls of function and the tracemalloc peak of one more call"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'median_seconds': statistics.median(times), 'peak_mb': peak / 1e6}
+
+
+class Workload:
+    """the synthetic files of a benchmark run and the inputs of the stages, built on first use"""
+
+    def __init__(self, args, tmp_dir):
+        self.args = args
+        self.tmp_dir = tmp_dir
+        self.library_path = os.path.join(tmp_dir, 'synthetic_library.msp')
+        self.run_path = os.path.join(tmp_dir, f"synthetic_run.{args.format}")
+        library = synthetic.make_library(args.library_size, args.library_peaks, seed=args.seed)
+        synthetic.write_msp(library, self.library_path)
+        synthetic.write_run(library, self.run_path, args.scans, peaks_per_scan=args.peaks_per_scan,
+                            cvs=tuple(args.cvs), n_windows=args.windows, seed=args.seed + 1)
+        self.results_dir = os.path.join(tmp_dir, 'results')
+        os.makedirs(self.results_dir)
+        synthetic.write_result_files(self.results_dir, args.merge_files, args.merge_rows, seed=args.seed + 2)
+        self._library = None
+        self._analyzer = None
+        self._peaks = None
+
+    @property
+    def library(self) -> LibraryIndex:
+        if self._library is None:
+            self._library = LibraryIndex(LibraryLoadingStrategy(self.library_path).load_spectral_library(use_cache=False))
+        return self._library
+
+    @property
+    def analyzer(self) -> QueryTargetedSpectrum:
+        """reader of the run with every scan decoded, so that the scan stages do not measure file parsing"""
+        if self._analyzer is None:
+            self._analyzer = QueryTargetedSpectrum(self.run_path, scan_cache_size=self.args.scans)
+            self.ms2_scans = [scan for scan in range(self._analyzer.get_scans())
+                              if self._analyzer.get_scan_record(scan).ms_level == 2]
+        return self._analyzer
+
+    @property
+    def peaks(self) -> list:
+        """(query peaks, target peaks) of every MS2 scan"""
+        if self._peaks is None:
+            analyzer = self.analyzer
+            self._peaks = [(analyzer.get_query_peaks(scan), analyzer.get_target_peaks(scan, self.library, self.args.pimt))
+                           for scan in self.ms2_scans]
+        return self._peaks
+
+
+def stage_functions(workload) -> dict:
+    args = workload.args
+
+    def load_msp():
+        LibraryLoadingStrategy(workload.library_path)._load_msp()
+
+    def get_realtime_lib():
+        analyzer = workload.analyzer
+        analyzer.candidate_cache = CandidateCache(max_size=0)
+        for scan in workload.ms2_scans:
+            analyzer.get_realtime_lib(scan, workload.library, args.pimt)
+            analyzer.get_target_peaks(scan, workload.library, args.pimt)
+
+    def match():
+        for query, target in workload.peaks:
+            match_spectrum(query, target, args.ppm)
+
+    matches = []
+
+    def score():
+        if not matches:
+            matches.extend(match_spectrum(query, target, args.ppm) for query, target in workload.peaks)
+        for matched_peaks in matches:
+            score_candidates(matched_peaks, args.min_matched_peaks)
+
+    def merge_dfs():
+        Meta_df_Merge(workload.results_dir).merge_dfs()
+
+    def end_to_end():
+        output_dir = tempfile.mkdtemp(dir=workload.tmp_dir)
+        library = LibraryIndex(LibraryLoadingStrategy(workload.library_path).load_spectral_library(use_cache=False))
+        run_identification([workload.run_path], library, args.pimt, args.cosine_threshold, args.ppm,
+                           args.min_matched_peaks, output_dir, n_workers=args.workers)
+        Meta_df_Merge(output_dir).merge_dfs()
+
+    return {'load_msp': load_msp, 'get_realtime_lib': get_realtime_lib, 'match_spectrum': match,
+            'score': score, 'merge_dfs': merge_dfs, 'end_to_end': end_to_end}
+
+
+# differences below these are noise whatever the ratio
+MIN_DIFFERENCE = {'seconds': 0.001, 'peak_mb': 0.5}
+
+
+def compare(results, baseline, tolerance) -> list:
+    """print results next to the baseline, returns the regressions as (stage, metric, ratio)"""
+    regressions = []
+    print(f"{'stage':>18} {'seconds':>10} {'baseline':>10} {'ratio':>7} {'peak MB':>9} {'baseline':>9} {'ratio':>7}")
+    for stage, result in results.items():
+        reference = baseline['results'].get(stage)
+        if reference is None:
+            print(f"{stage:>18} {result['seconds']:10.4f} {'-':>10} {'-':>7} {result['peak_mb']:9.2f} {'-':>9} {'-':>7}")
+            continue
+        ratios = {}
+        for metric in ('seconds', 'peak_mb'):
+            ratios[metric] = result[metric] / reference[metric] if reference[metric] > 0 else 1.0
+            if ratios[metric] > 1 + tolerance and result[metric] - reference[metric] > MIN_DIFFERENCE[metric]:
+                regressions.append((stage, metric, ratios[metric]))
+        print(f"{stage:>18} {result['seconds']:10.4f} {reference['seconds']:10.4f} {ratios['seconds']:7.2f} "
+              f"{result['peak_mb']:9.2f} {reference['peak_mb']:9.2f} {ratios['peak_mb']:7.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scans', type=int, default=2000)
+    parser.add_argument('--peaks-per-scan', type=int, default=300)
+    parser.add_argument('--cvs', type=float, nargs='+', default=[-40.0, -60.0])
+    parser.add_argument('--windows', type=int, default=50)
+    parser.add_argument('--format', choices=['mzML', 'mzXML'], default='mzML')
+    parser.add_argument('--library-size', type=int, default=20000)
+    parser.add_argument('--library-peaks', type=int, default=10)
+    parser.add_argument('--merge-files', type=int, default=20)
+    parser.add_argument('--merge-rows', type=int, default=20000)
+    parser.add_argument('--pimt', type=float, default=0.5, help='precursor ion mass tolerance, Da')
+    parser.add_argument('--ppm', type=float, default=20)
+    parser.add_argument('--min-matched-peaks', type=int, default=2)
+    parser.add_argument('--cosine-threshold', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, default=1, help='identification processes of the end to end stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='JSON')
+    parser.add_argument('--compare', metavar='JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ('stages', 'repeat', 'save_baseline', 'compare', 'tolerance')}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        workload = Workload(args, tmp_dir)
+        print(f"synthetic data written in {time.perf_counter() - start:.1f} s "
+              f"({os.path.getsize(workload.run_path) / 1e6:.1f} MB run, {os.path.getsize(workload.library_path) / 1e6:.1f} MB library)")
+        functions = stage_functions(workload)
+        for stage in args.stages:
+            functions[stage]()   # warm up: builds the inputs of the stage, imports, caches of the file system
+            results[stage] = measure(functions[stage], args.repeat)
+            print(f"{stage:>18}: {results[stage]['seconds']:10.4f} s (median {results[stage]['median_seconds']:.4f} s), "
+                  f"peak {results[stage]['peak_mb']:.2f} MB")
+
+    report = {'config': config, 'results': results,
+              'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()}}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline['config'] != config:
+            print("warning: the baseline was measured with a different configuration")
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, metric, ratio in regressions:
+            print(f"regression: {stage} {metric} {ratio:.2f}x of the baseline")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
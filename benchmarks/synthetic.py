@@ -0,0 +1,184 @@
+"""
+Deterministic synthetic data for the benchmarks: .msp libraries, direct infusion MS runs (.mzML/.mzXML) with
+FAIMS compensation voltages and identification result files for the quantification merge.
+The same arguments and seed always give the same files.
+
+    python benchmarks/synthetic.py out_dir [--library-size 20000] [--library-peaks 10] [--scans 2000]
+                                           [--peaks-per-scan 300] [--cvs -40 -60] [--format mzML]
+"""
+
+import argparse
+import base64
+import os
+
+import numpy as np
+import pandas as pd
+
+
+RESULT_COLUMNS = ['PrecursorMZ', 'Compensation Voltage', 'Cosine_score', 'Ion_count', 'Scan',
+                  'Compound', 'CompoundMZ', 'Adduct', 'Formula', 'Macc_score', 'Matched_peaks', 'Scans']
+
+
+def make_library(n_spectra, max_peaks=10, seed=0, precursor_range=(60.0, 900.0)) -> list:
+    """n_spectra library spectra as dicts like the library loaders return, each with 1 to max_peaks fragment peaks below its precursor"""
+    rng = np.random.default_rng(seed)
+    library = []
+    for i in range(n_spectra):
+        precursor = round(float(rng.uniform(*precursor_range)), 4)
+        n_peaks = int(rng.integers(1, max_peaks + 1))
+        library.append({'name': f"Compound_{i}",
+                        'precursormz': precursor,
+                        'precursor_type': '[M+H]+',
+                        'formula': f"C{int(rng.integers(1, 40))}H{int(rng.integers(1, 80))}O{int(rng.integers(0, 20))}",
+                        'mz': np.round(np.sort(rng.uniform(precursor_range[0] - 20, precursor, n_peaks)), 4),
+                        'intensity': np.round(rng.uniform(1, 1000, n_peaks), 2)})
+    return library
+
+
+def write_msp(library, file_path):
+    """write library spectra as an .msp library"""
+    with open(file_path, 'w', encoding='utf-8') as file:
+        for spectrum in library:
+            file.write(f"Name: {spectrum['name']}\nPrecursorMZ: {spectrum['precursormz']}\n"
+                       f"Precursor_type: {spectrum['precursor_type']}\nFormula: {spectrum['formula']}\n"
+                       f"Num Peaks: {len(spectrum['mz'])}\n")
+            for mz, intensity in zip(spectrum['mz'], spectrum['intensity']):
+                file.write(f"{mz} {intensity}\n")
+            file.write("\n")
+
+
+def iter_scans(library, n_scans, peaks_per_scan=300, cvs=(-40.0, -60.0), n_windows=50, ms1_every=10,
+               planted=3, ppm_error=2.0, seed=1):
+    """
+    Scans of a DI-MS run as (ms level, precursor, cv, mz array, intensity array).
+    Every ms1_every-th scan is an MS1 scan, the MS2 scans cycle through n_windows isolation windows (centred on
+    library precursors) at each compensation voltage of cvs. An MS2 scan has peaks_per_scan noise peaks plus the
+    fragments of up to planted library spectra of its window, shifted by ppm_error ppm (sd) and above the default
+    intensity threshold, so that the identification finds hits.
+    """
+    rng = np.random.default_rng(seed)
+    precursors = np.array([spectrum['precursormz'] for spectrum in library])
+    windows = np.unique(np.round(rng.choice(precursors, size=min(n_windows, len(precursors)), replace=False)) + 0.5)
+    window_spectra = [np.flatnonzero(np.abs(precursors - window) < 1.0)[:planted] for window in windows]
+    low, high = float(precursors.min()) - 20, float(precursors.max())
+
+    ms2_count = 0
+    for scan in range(n_scans):
+        if scan % ms1_every == 0:
+            mz = np.sort(rng.uniform(low, high, peaks_per_scan))
+            yield 1, None, cvs[(ms2_count // len(cvs)) % len(cvs)], mz, rng.uniform(1e3, 1e6, peaks_per_scan)
+            continue
+        cv = cvs[ms2_count % len(cvs)]
+        w = (ms2_count // len(cvs)) % len(windows)
+        ms2_count += 1
+        mz = [rng.uniform(low, high, peaks_per_scan)]
+        intensity = [rng.uniform(100, 1e4, peaks_per_scan)]
+        for i in window_spectra[w]:
+            fragments = library[i]['mz']
+            mz.append(fragments * (1 + rng.normal(0, ppm_error * 1e-6, len(fragments))))
+            intensity.append(library[i]['intensity'] * 100 + 5000)
+        mz, intensity = np.concatenate(mz), np.concatenate(intensity)
+        order = np.argsort(mz, kind='stable')
+        yield 2, float(windows[w]), cv, mz[order], intensity[order]
+
+
+def _b64(values, dtype):
+    return base64.b64encode(np.asarray(values, dtype=dtype).tobytes()).decode()
+
+
+def write_mzml(scans, file_path):
+    """write scans of iter_scans as an uncompressed mzML file"""
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="utf-8"?>\n<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+                   '<run id="synthetic"><spectrumList>\n')
+        for index, (ms_level, precursor, cv, mz, intensity) in enumerate(scans):
+            file.write(f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="{len(mz)}">\n'
+                       f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>\n'
+                       f'<cvParam cvRef="MS" accession="MS:1001581" name="FAIMS compensation voltage" value="{cv}"/>\n')
+            if ms_level == 2:
+                file.write('<precursorList count="1"><precursor><isolationWindow><cvParam cvRef="MS" accession="MS:1000827" '
+                           f'name="isolation window target m/z" value="{precursor}"/></isolationWindow></precursor></precursorList>\n')
+            file.write('<binaryDataArrayList count="2">\n')
+            for values, accession, name in ((mz, 'MS:1000514', 'm/z array'), (intensity, 'MS:1000515', 'intensity array')):
+                file.write('<binaryDataArray><cvParam cvRef="MS" accession="MS:1000523" name="64-bit float"/>'
+                           '<cvParam cvRef="MS" accession="MS:1000576" name="no compression"/>'
+                           f'<cvParam cvRef="MS" accession="{accession}" name="{name}"/>'
+                           f'<binary>{_b64(values, "<f8")}</binary></binaryDataArray>\n')
+            file.write('</binaryDataArrayList></spectrum>\n')
+        file.write('</spectrumList></run></mzML>\n')
+
+
+def write_mzxml(scans, file_path):
+    """write scans of iter_scans as an uncompressed mzXML file"""
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                   '<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n<msRun>\n')
+        for index, (ms_level, precursor, cv, mz, intensity) in enumerate(scans):
+            pairs = np.empty(2 * len(mz))
+            pairs[0::2], pairs[1::2] = mz, intensity
+            file.write(f'<scan num="{index + 1}" msLevel="{ms_level}" peaksCount="{len(mz)}" compensationVoltage="{cv}">\n')
+            if ms_level == 2:
+                file.write(f'<precursorMz precursorIntensity="0">{precursor}</precursorMz>\n')
+            file.write('<peaks precision="64" byteOrder="network" contentType="m/z-int" compressionType="none">'
+                       f'{_b64(pairs, ">f8")}</peaks></scan>\n')
+        file.write('</msRun></mzXML>\n')
+
+
+def write_run(library, file_path, n_scans, **kwargs):
+    """write a synthetic run (see iter_scans for the options), .mzML or .mzXML following the file extension"""
+    scans = iter_scans(library, n_scans, **kwargs)
+    if file_path.lower().endswith('.mzml'):
+        write_mzml(scans, file_path)
+    elif file_path.lower().endswith('.mzxml'):
+        write_mzxml(scans, file_path)
+    else:
+        raise ValueError(f"Unsupported file format: {file_path}")
+
+
+def write_result_files(folder, n_files, n_rows, n_windows=500, cvs=(-40.0, -60.0), seed=2) -> list:
+    """write n_files identification result .csv files of n_rows rows over shared precursor windows, returns their paths"""
+    rng = np.random.default_rng(seed)
+    windows = np.round(rng.uniform(60, 900, n_windows), 1) + 0.5
+    paths = []
+    for i in range(n_files):
+        window = rng.integers(0, n_windows, n_rows)
+        rows = {'PrecursorMZ': windows[window],
+                'Compensation Voltage': np.asarray(cvs)[rng.integers(0, len(cvs), n_rows)],
+                'Cosine_score': np.round(rng.uniform(0.5, 1, n_rows), 4),
+                'Ion_count': np.round(rng.uniform(1e3, 1e7, n_rows), 1),
+                'Scan': rng.integers(0, 100000, n_rows),
+                'Compound': [f"Compound_{j}" for j in rng.integers(0, 20000, n_rows)],
+                'CompoundMZ': windows[window] - 0.5,
+                'Adduct': '[M+H]+',
+                'Formula': 'C6H12O6',
+                'Macc_score': np.round(rng.uniform(0, 1, n_rows), 4),
+                'Matched_peaks': rng.integers(2, 10, n_rows)}
+        rows['Scans'] = rows['Scan'].astype(str)
+        path = os.path.join(folder, f"sample_{i}.csv")
+        pd.DataFrame(rows, columns=RESULT_COLUMNS).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--library-size', type=int, default=20000)
+    parser.add_argument('--library-peaks', type=int, default=10)
+    parser.add_argument('--scans', type=int, default=2000)
+    parser.add_argument('--peaks-per-scan', type=int, default=300)
+    parser.add_argument('--cvs', type=float, nargs='+', default=[-40.0, -60.0])
+    parser.add_argument('--windows', type=int, default=50)
+    parser.add_argument('--format', choices=['mzML', 'mzXML'], default='mzML')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    library = make_library(args.library_size, args.library_peaks, seed=args.seed)
+    write_msp(library, os.path.join(args.out_dir, 'synthetic_library.msp'))
+    write_run(library, os.path.join(args.out_dir, f"synthetic_run.{args.format}"), args.scans,
+              peaks_per_scan=args.peaks_per_scan, cvs=tuple(args.cvs), n_windows=args.windows, seed=args.seed + 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+Headless entry point of DImeta: library reformatting, metabolite identification and quantification merge
+without the PyQt5 GUI, for scripts, schedulers and cluster nodes.
+
+Command line, parameters come from the options and/or a JSON config file (options take precedence):
+
+    python dimeta_cli.py reformat --inputs lib1.msp lib2.mgf --output-dir out --topnum 10
+    python dimeta_cli.py identify --config identify.json --workers 8
+    python dimeta_cli.py merge --input-folder results --output-folder quan
+
+A config file holds the parameters of one command, either at the top level or in a section named after the
+command ({"identify": {...}}), keys are the long option names with underscores, e.g.
+
+    {"inputs": ["run1.mzML"], "library": "lib.msp", "output_dir": "results", "ppm_tolerance": 20,
+     "precursor_tolerance": 0.5, "min_matched_peaks": 2, "cosine_threshold": 0.7, "workers": 8}
+
+The same functions can be called from Python: reformat_libraries, identify and merge_results.
+Only numpy and the identification modules are imported at startup, matplotlib (plots) and pandas (result files)
+are imported when they are used and PyQt5 never.
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+for _folder in ('identification', 'Library loading'):
+    if os.path.join(_ROOT, _folder) not in sys.path:
+        sys.path.insert(0, os.path.join(_ROOT, _folder))
+
+from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, BINARY_LIBRARY_EXTENSION
+from progress import ProgressReporter, format_progress
+
+
+def reformat_libraries(input_paths, output_dir, topnum=10, binary=False, output_name=None, progress_callback=None) -> dict:
+    """
+    Combine and reformat libraries (.msp/.mgf) into one .msp library with the topnum most intense peaks per spectrum,
+    streamed in constant memory. With binary also the memory-mappable binary library next to it, for which the
+    reformatted library is loaded into memory (the identification otherwise creates it on the first load).
+    Returns {'library': msp path, 'binary_library': binary path or None, 'spectra': number of spectra}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if output_name is None:
+        import uuid
+        output_name = f"reformatted_library_{uuid.uuid4()}.msp"
+    output_file_path = os.path.join(output_dir, output_name)
+
+    combined_library = LibraryLoadingStrategy.iter_combined_libraries(input_paths)
+    reformatted_library = LibraryReformat(topnum).iter_reformat_library(combined_library)
+    progress = ProgressReporter(progress_callback, label='Reformatting', unit='spectra')
+    count = LibrarySaveStrategy.save_library_to_msp_class(reformatted_library, output_file_path,
+                                                          progress_callback=lambda count: progress.update(count - progress.done))
+    progress.done = count
+    progress.finish()
+
+    binary_file_path = None
+    if binary:
+        binary_file_path = output_file_path + BINARY_LIBRARY_EXTENSION
+        library = LibraryLoadingStrategy(output_file_path).load_spectral_library(use_cache=False)
+        LibrarySaveStrategy.save_library_to_binary(library, binary_file_path, source_path=output_file_path)
+    return {'library': output_file_path, 'binary_library': binary_file_path, 'spectra': count}
+
+
+def identify(input_paths, library_path, output_dir, ppm_tolerance, precursor_tolerance, min_matched_peaks,
+             cosine_threshold, intensity_threshold=3000, lower_scan=0, higher_scan=None, workers=1, chunk_size=500,
+             aggregate=None, output_format='csv', excel_export=False, checkpoint=True, generate_plots=False,
+             plot_format='svg', plot_top_n=None, plot_min_score=None, plot_workers=1, centroid=False, centroid_ppm=10.0,
+             centroid_valley=0.5, snr=None, relative_threshold=None, top_n=None, top_n_window=100.0, progress_callback=None,
+             cancel=None) -> dict:
+    """
+    Identify metabolites in the input files (.mzML/.mzXML) against the library and write one result file per input
+    into output_dir, see querylibrarymatch.run_identification. Returns {input file path: result file path}.
+    centroid, snr, relative_threshold and top_n preprocess the query spectra before matching (see QueryPreprocessing).
+    """
+    from IdentificationMeta import LibraryIndex, QueryPreprocessing
+    from querylibrarymatch import run_identification
+    os.makedirs(output_dir, exist_ok=True)
+    preprocessing = None
+    if centroid or snr is not None or relative_threshold is not None or top_n is not None:
+        preprocessing = QueryPreprocessing(centroid=centroid, centroid_ppm=centroid_ppm, centroid_valley=centroid_valley,
+                                           snr=snr, relative_threshold=relative_threshold, top_n=top_n,
+                                           window=top_n_window)
+    library = LibraryIndex(LibraryLoadingStrategy(library_path).load_spectral_library())
+    return run_identification(list(input_paths), library, precursor_tolerance, cosine_threshold, ppm_tolerance,
+                              min_matched_peaks, output_dir, intensity_threshold=intensity_threshold,
+                              lowerscan=lower_scan, higherscan=higher_scan, generate_plots=generate_plots,
+                              n_workers=workers, chunk_size=chunk_size, aggregate=aggregate, output_format=output_format,
+                              excel_export=excel_export, checkpoint=checkpoint, plot_format=plot_format,
+                              plot_top_n=plot_top_n, plot_min_score=plot_min_score, plot_workers=plot_workers,
+                              preprocessing=preprocessing, progress_callback=progress_callback, cancel=cancel)
+
+
+def merge_results(input_folder, output_folder=None, output_filename='merged_output.csv', layout='wide', workers=1,
+                  incremental=False, align_ppm=None, align_cv_tolerance=0.0, compounds=False, progress_callback=None) -> str:
+    """
+    Merge the identification results in input_folder into one quantification table and return its path.
+    layout 'wide' writes labels x samples, 'long' one row per measured (label, sample), the format follows the
+    output_filename extension (.csv or .parquet). Result files are read by workers processes.
+    With incremental only result files added or changed since the last incremental merge are read (see QuantStore).
+    With align_ppm features are aligned by m/z tolerance and CV (see align_features) instead of rounded labels, the
+    mapping of the sample rows to the features is written next to the table as <output name>_mapping.<extension>.
+    compounds also writes the compound level table (best identification per aligned feature and per sample
+    intensities, see FeatureAlignment.compound_table) as <output name>_compounds.<extension>, the features are then
+    aligned by align_ppm or 10 ppm.
+    """
+    from meta_quan_merge import Meta_df_Merge, side_table_filename
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+    if align_ppm is not None or compounds:
+        if incremental:
+            raise ValueError("feature alignment reads all result files, it cannot be combined with incremental")
+        processor = Meta_df_Merge(input_folder)
+        alignment = processor.align_features(align_ppm if align_ppm is not None else 10.0, align_cv_tolerance,
+                                             identifications=compounds, progress_callback=progress_callback,
+                                             n_workers=workers)
+        table = alignment.matrix.to_long() if layout == 'long' else alignment.feature_table()
+        processor.save_final_df(alignment.mapping, output_folder, side_table_filename(output_filename, 'mapping'))
+        if compounds:
+            processor.save_final_df(alignment.compound_table(), output_folder, side_table_filename(output_filename, 'compounds'))
+    else:
+        if incremental:
+            from quant_store import QuantStore
+            processor = QuantStore(input_folder)
+        else:
+            processor = Meta_df_Merge(input_folder)
+        matrix = processor.merge_quantities(progress_callback=progress_callback, n_workers=workers)
+        table = matrix.to_long() if layout == 'long' else matrix.to_wide()
+    processor.save_final_df(table, output_folder, output_filename)
+    return os.path.normpath(os.path.join(output_folder or input_folder, output_filename))
+
+
+def load_config(file_path, command) -> dict:
+    """parameters of command from a JSON config file, the section named after the command or the top level"""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    if isinstance(config.get(command), dict):
+        config = config[command]
+    return {key.replace('-', '_'): value for key, value in config.items()}
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='DImeta without the GUI: library reformatting, identification and quantification merge')
+    parser.add_argument('--quiet', action='store_true', help='no progress output')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # defaults are None so that values of the config file are only overridden by options given on the command line
+    reformat = commands.add_parser('reformat', help='combine and reformat .msp/.mgf libraries')
+    reformat.add_argument('--config')
+    reformat.add_argument('--inputs', nargs='+')
+    reformat.add_argument('--output-dir')
+    reformat.add_argument('--topnum', type=int)
+    reformat.add_argument('--output-name')
+    reformat.add_argument('--binary', action='store_const', const=True,
+                          help='also write the binary library, loads the reformatted library into memory')
+
+    ident = commands.add_parser('identify', help='identify metabolites in .mzML/.mzXML files')
+    ident.add_argument('--config')
+    ident.add_argument('--inputs', nargs='+')
+    ident.add_argument('--library')
+    ident.add_argument('--output-dir')
+    ident.add_argument('--ppm-tolerance', type=float)
+    ident.add_argument('--precursor-tolerance', type=float, help='precursor ion mass tolerance, Da')
+    ident.add_argument('--min-matched-peaks', type=int)
+    ident.add_argument('--cosine-threshold', type=float)
+    ident.add_argument('--intensity-threshold', type=float)
+    ident.add_argument('--lower-scan', type=int)
+    ident.add_argument('--higher-scan', type=int)
+    ident.add_argument('--workers', type=int, help='identification processes')
+    ident.add_argument('--chunk-size', type=int, help='scans per work unit')
+    ident.add_argument('--aggregate', choices=['sum', 'mean'], help='merge replicate scans per window')
+    ident.add_argument('--output-format', choices=['csv', 'parquet', 'xlsx'])
+    ident.add_argument('--excel-export', action='store_const', const=True)
+    ident.add_argument('--no-checkpoint', dest='checkpoint', action='store_const', const=False)
+    ident.add_argument('--plots', dest='generate_plots', action='store_const', const=True)
+    ident.add_argument('--plot-format', choices=['svg', 'png', 'pdf'])
+    ident.add_argument('--plot-top-n', type=int)
+    ident.add_argument('--plot-min-score', type=float)
+    ident.add_argument('--plot-workers', type=int)
+    ident.add_argument('--centroid', action='store_const', const=True, help='centroid profile mode query spectra')
+    ident.add_argument('--centroid-ppm', type=float, help='m/z gap that separates profile peaks, ppm')
+    ident.add_argument('--centroid-valley', type=float,
+                       help='split profile peaks only at valleys below this fraction of the smaller neighbouring apex')
+    ident.add_argument('--snr', type=float, help='remove query peaks below this multiple of the median intensity of the scan')
+    ident.add_argument('--relative-threshold', type=float, help='remove query peaks below this fraction of the base peak')
+    ident.add_argument('--top-n', type=int, help='keep the top N query peaks per m/z window')
+    ident.add_argument('--top-n-window', type=float, help='width of the top N windows, Da')
+
+    merge = commands.add_parser('merge', help='merge identification results into a quantification table')
+    merge.add_argument('--config')
+    merge.add_argument('--input-folder')
+    merge.add_argument('--output-folder')
+    merge.add_argument('--output-filename', help='.csv or .parquet')
+    merge.add_argument('--layout', choices=['wide', 'long'], help='long: one row per measured label and sample')
+    merge.add_argument('--workers', type=int, help='processes reading the result files')
+    merge.add_argument('--incremental', action='store_const', const=True,
+                       help='keep the merged quantities in the input folder and only read new or changed result files')
+    merge.add_argument('--align-ppm', type=float, help='align features by this m/z tolerance instead of rounded precursors')
+    merge.add_argument('--align-cv-tolerance', type=float, help='compensation voltages at most this far apart are aligned')
+    merge.add_argument('--compounds', action='store_const', const=True,
+                       help='also write the compound level table: best identification per aligned feature, intensity per sample')
+    return parser
+
+
+_REQUIRED = {'reformat': ['inputs', 'output_dir'],
+             'identify': ['inputs', 'library', 'output_dir', 'ppm_tolerance', 'precursor_tolerance',
+                          'min_matched_peaks', 'cosine_threshold'],
+             'merge': ['input_folder']}
+
+
+def main(argv=None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    params = load_config(args.config, args.command) if args.config else {}
+    params.update({key: value for key, value in vars(args).items()
+                   if value is not None and key not in ('command', 'config', 'quiet')})
+    missing = [key for key in _REQUIRED[args.command] if key not in params]
+    if missing:
+        parser.error(f"{args.command}: missing parameters {', '.join(missing)}")
+    progress_callback = None if args.quiet else lambda info: logging.info(format_progress(info))
+
+    if args.command == 'reformat':
+        result = reformat_libraries(params.pop('inputs'), params.pop('output_dir'), progress_callback=progress_callback, **params)
+        logging.info(f"{result['spectra']} spectra saved to {result['library']}")
+    elif args.command == 'identify':
+        results = identify(params.pop('inputs'), params.pop('library'), params.pop('output_dir'),
+                           progress_callback=progress_callback, **params)
+        failed = [path for path, result in results.items() if result is None]
+        for path in failed:
+            logging.error(f"Identification failed for {path}")
+        return 1 if failed else 0
+    else:
+        merge_results(params.pop('input_folder'), progress_callback=progress_callback, **params)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,325 @@
 
-import pyteomics.mzml
-from pyteomics import mzxml, mzml
 import os
-import pandas as pd
-import glob
 import numpy as np
 import heapq
-from collections import defaultdict
+import itertools
+from collections import defaultdict, namedtuple, OrderedDict
+
+_library_versions = itertools.count()
+
+
+class LibraryIndex:
+    """precursor m/z index over a spectral library,
+    precursor values are parsed and sorted once so that the candidates of a scan are found by binary search"""
+
+    def __init__(self, library):
+        self.library = library
+        self.version = next(_library_versions)   # distinguishes indexes in cache keys, a rebuilt index gets a new version
+        precursors = getattr(library, 'precursor_mz', None)   # array-backed libraries carry the parsed column
+        if precursors is None:
+            precursors = np.asarray([float(item['precursormz']) for item in library], dtype=np.float64)
+        self.order = getattr(library, 'precursor_order', None)
+        if self.order is None:
+            self.order = np.argsort(precursors, kind='stable')
+        self.sorted_precursors = precursors[self.order]
+
+    def __len__(self):
+        return len(self.library)
+
+    def __iter__(self):
+        return iter(self.library)
+
+    def __getitem__(self, i):
+        return self.library[i]
+
+    def window_indices(self, precursor, PIMT) -> np.ndarray:
+        """library positions with precursor - PIMT < precursormz < precursor + PIMT, in library order"""
+        lower = np.searchsorted(self.sorted_precursors, precursor - PIMT, side='right')
+        upper = np.searchsorted(self.sorted_precursors, precursor + PIMT, side='left')
+        if upper <= lower:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(self.order[lower:upper])
+
+    def window(self, precursor, PIMT) -> list:
+        return [self.library[i] for i in self.window_indices(precursor, PIMT)]
+
+    def target_peaks(self, indices) -> 'PeakArrays':
+        """peaks of the library spectra at indices as arrays sorted by m/z, labelled with the position in indices.
+        Array-backed libraries are gathered straight from the flat peak arrays."""
+        if not len(indices):
+            return PeakArrays(np.empty(0), np.empty(0), np.empty(0, dtype=np.intp))
+        offsets = getattr(self.library, 'offsets', None)
+        if offsets is None:
+            real = [self.library[i] for i in indices]
+            mz = np.concatenate([np.asarray(item['mz'], dtype=np.float64) for item in real])
+            inten = np.concatenate([np.asarray(item['intensity'], dtype=np.float64) for item in real])
+            label = np.repeat(np.arange(len(real)), [len(item['mz']) for item in real])
+            order = np.argsort(mz, kind='stable')
+            return PeakArrays(mz[order], inten[order], label[order])
+
+        starts = offsets[indices]
+        counts = offsets[indices + 1] - starts
+        label = np.repeat(np.arange(len(indices)), counts)
+        peak_ids = np.arange(len(label)) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        order = np.argsort(self.library.mz[peak_ids], kind='stable')
+        peak_ids, label = peak_ids[order], label[order]
+        return PeakArrays(self.library.mz[peak_ids], self.library.intensity[peak_ids], label)
+
+
+class PeakArrays:
+    """peak list held as contiguous m/z and intensity arrays,
+    label is one value for the whole spectrum (query) or an array with one label per peak (target, index of the library spectrum)"""
+
+    __slots__ = ('mz', 'intensity', 'label')
+
+    def __init__(self, mz, intensity, label):
+        self.mz = mz
+        self.intensity = intensity
+        self.label = label
+
+    def __len__(self):
+        return len(self.mz)
+
+    def labels(self) -> np.ndarray:
+        if isinstance(self.label, np.ndarray):
+            return self.label
+        return np.full(len(self.mz), self.label, dtype=object)
+
+    def __getitem__(self, i) -> tuple:
+        return (self.mz[i], self.intensity[i], self.label[i] if isinstance(self.label, np.ndarray) else self.label)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class MatchedPeaks:
+    """matched query/target peak pairs held column-wise,
+    rows read like the tuples of match_spectrum (query_mz, query_intensity, query_label, target_mz, target_intensity, target_label)"""
+
+    __slots__ = ('query', 'target', 'query_index', 'target_index')
+    columns = ('query_mz', 'query_intensity', 'query_label', 'target_mz', 'target_intensity', 'target_label')
+
+    def __init__(self, query, target, query_index, target_index):
+        self.query = query
+        self.target = target
+        self.query_index = query_index
+        self.target_index = target_index
+
+    @property
+    def query_mz(self) -> np.ndarray:
+        return self.query.mz[self.query_index]
+
+    @property
+    def query_intensity(self) -> np.ndarray:
+        return self.query.intensity[self.query_index]
+
+    @property
+    def query_label(self) -> np.ndarray:
+        return self.query.labels()[self.query_index]
+
+    @property
+    def target_mz(self) -> np.ndarray:
+        return self.target.mz[self.target_index]
+
+    @property
+    def target_intensity(self) -> np.ndarray:
+        return self.target.intensity[self.target_index]
+
+    @property
+    def target_label(self) -> np.ndarray:
+        return self.target.labels()[self.target_index]
+
+    def column(self, position) -> np.ndarray:
+        """column of the row tuples by position, e.g. -1 for the target label"""
+        return getattr(self, self.columns[position])
+
+    def take(self, rows) -> 'MatchedPeaks':
+        return MatchedPeaks(self.query, self.target, self.query_index[rows], self.target_index[rows])
+
+    def __len__(self):
+        return len(self.query_index)
+
+    def __getitem__(self, i) -> tuple:
+        return self.query[self.query_index[i]] + self.target[self.target_index[i]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class CandidateSet:
+    """candidates of one isolation window: library positions, the real-time library and its target peaks,
+    the latter two are built on first use"""
+
+    __slots__ = ('library', 'indices', '_entries', '_peaks')
+
+    def __init__(self, library, indices):
+        self.library = library
+        self.indices = indices
+        self._entries = None
+        self._peaks = None
+
+    def entries(self) -> list:
+        if self._entries is None:
+            self._entries = [self.library[i] for i in self.indices]
+        return self._entries
+
+    def peaks(self) -> 'PeakArrays':
+        if self._peaks is None:
+            self._peaks = self.library.target_peaks(self.indices)
+        return self._peaks
+
+
+class CandidateCache:
+    """LRU cache of CandidateSet keyed on (precursor target, PIMT, library version),
+    DI-MS runs acquire the same isolation windows over and over so consecutive cycles reuse the candidates of the first"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._sets = OrderedDict()   # key -> CandidateSet, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sets)
+
+    def get(self, library, precursor, PIMT) -> CandidateSet:
+        """candidates of the window precursor +- PIMT in the LibraryIndex library, built on a miss"""
+        key = (float(precursor), float(PIMT), library.version)
+        candidates = self._sets.get(key)
+        if candidates is not None:
+            self.hits += 1
+            self._sets.move_to_end(key)
+            return candidates
+
+        self.misses += 1
+        candidates = CandidateSet(library, library.window_indices(precursor, PIMT))
+        if self.max_size > 0:
+            self._sets[key] = candidates
+            if len(self._sets) > self.max_size:
+                self._sets.popitem(last=False)
+        return candidates
+
+    def clear(self):
+        self._sets.clear()
+        self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._sets)}
+
+
+class ScanRecord(namedtuple('ScanRecord', ['ms_level', 'mz', 'intensity', 'precursor', 'compensation_voltage'])):
+    """decoded content of one scan, read from the input file once and shared by all accessors"""
+    __slots__ = ()
+
+
+class QueryPreprocessing:
+    """
+    Peak list preprocessing of MS2 query spectra before matching, applied in this order:
+    centroid        profile data is centroided: consecutive points within centroid_ppm of each other form a profile peak,
+                    split at valleys below centroid_valley times the smaller of the two apexes next to them (see
+                    centroid_peaks), the centroid m/z is the intensity weighted mean m/z and the centroid intensity
+                    the apex intensity
+    snr             the noise level of a scan is estimated as the median intensity of its peaks (after centroiding,
+                    before any threshold), peaks below snr times the noise level are removed
+    relative_threshold  peaks below this fraction of the base peak intensity are removed
+    top_n           only the top_n most intense peaks of every m/z window of width window (Da) are kept
+    The absolute intensity_threshold of QueryTargetedSpectrum is applied after centroiding, options left at None are skipped.
+    """
+
+    def __init__(self, centroid=False, centroid_ppm=10.0, snr=None, relative_threshold=None, top_n=None, window=100.0,
+                 centroid_valley=0.5):
+        if not 0 < centroid_valley <= 1:
+            raise ValueError(f"centroid_valley must be in (0, 1]: {centroid_valley}")
+        if top_n is not None and top_n < 1:
+            raise ValueError(f"top_n must be at least 1: {top_n}")
+        if window <= 0:
+            raise ValueError(f"window must be positive: {window}")
+        self.centroid = centroid
+        self.centroid_ppm = centroid_ppm
+        self.centroid_valley = centroid_valley
+        self.snr = snr
+        self.relative_threshold = relative_threshold
+        self.top_n = top_n
+        self.window = window
+
+    def params(self) -> dict:
+        """settings as a JSON serializable dict, recorded with the parameters of checkpointed runs"""
+        return {'centroid': self.centroid, 'centroid_ppm': self.centroid_ppm, 'centroid_valley': self.centroid_valley,
+                'snr': self.snr,
+                'relative_threshold': self.relative_threshold, 'top_n': self.top_n, 'window': self.window}
+
+    def apply(self, mz, intensity, intensity_threshold=0) -> tuple:
+        """(mz, intensity) of the preprocessed peak list, sorted by m/z"""
+        mz, intensity = np.asarray(mz, dtype=np.float64), np.asarray(intensity, dtype=np.float64)
+        if len(mz) > 1 and np.any(mz[1:] < mz[:-1]):
+            order = np.argsort(mz, kind='stable')
+            mz, intensity = mz[order], intensity[order]
+        if self.centroid:
+            mz, intensity = centroid_peaks(mz, intensity, self.centroid_ppm, self.centroid_valley)
+        if len(mz) == 0:
+            return mz, intensity
+
+        keep = intensity > intensity_threshold
+        if self.snr is not None:
+            keep &= intensity >= self.snr * np.median(intensity)
+        if self.relative_threshold is not None:
+            keep &= intensity >= self.relative_threshold * intensity.max()
+        mz, intensity = mz[keep], intensity[keep]
+        if self.top_n is not None and len(mz) > self.top_n:
+            windows = np.floor(mz / self.window)
+            order = np.lexsort((-intensity, windows))   # by window, most intense first within a window
+            starts = np.flatnonzero(np.concatenate(([True], windows[order][1:] != windows[order][:-1])))
+            rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+            keep = np.zeros(len(mz), dtype=bool)
+            keep[order[rank < self.top_n]] = True
+            mz, intensity = mz[keep], intensity[keep]
+        return mz, intensity
+
+
+def centroid_peaks(mz, intensity, ppm_tolerance, valley_ratio=0.5) -> tuple:
+    """
+    (mz, intensity) centroids of profile data sorted by m/z, see QueryPreprocessing.
+    Points of zero intensity are dropped and a gap above ppm_tolerance always separates profile peaks. Within a profile
+    the data is first cut at every local minimum, then neighbouring pieces are merged again unless the valley between
+    them is below valley_ratio times the smaller of their apexes, so noise on a peak does not split it.
+    Pieces are merged shallowest valley first: a valley that is lower than both neighbouring valleys waits while one of
+    them is still to be merged, so it is judged against the apexes of the merged pieces and not against a noise sliver.
+    """
+    positive = intensity > 0
+    mz, intensity = mz[positive], intensity[positive]
+    if len(mz) < 2:
+        return mz, intensity
+    gap = np.diff(mz) > ppm_tolerance * 1e-6 * mz[:-1]
+    # minima and valley depths are taken on a 3 point moving average, single noisy points do not make a valley
+    smoothed = np.convolve(intensity, np.full(3, 1 / 3), mode='same')
+    smoothed[[0, -1]] = intensity[[0, -1]]
+    # a point lower than both neighbours closes its piece, the next point starts a new one
+    minimum = np.zeros(len(mz) - 1, dtype=bool)
+    minimum[1:] = (smoothed[1:-1] < smoothed[:-2]) & (smoothed[1:-1] < smoothed[2:])
+    cut = gap | minimum
+    starts = np.flatnonzero(np.concatenate(([True], cut)))
+    # boundary j lies between piece j and j + 1, gaps are never merged
+    hard = gap[starts[1:] - 1]
+    valley = smoothed[starts[1:] - 1]
+    apex = np.maximum.reduceat(smoothed, starts)
+    while len(valley):
+        shallow = ~hard & (valley >= valley_ratio * np.minimum(apex[:-1], apex[1:]))
+        if not shallow.any():
+            break
+        # neighbouring boundaries of the same profile
+        has_left = np.concatenate(([False], ~hard[:-1]))
+        has_right = np.concatenate((~hard[1:], [False]))
+        left_valley = np.where(has_left, np.roll(valley, 1), np.inf)
+        right_valley = np.where(has_right, np.roll(valley, -1), np.inf)
+        lowest = (valley < left_valley) & (valley < right_valley)
+        waiting = (has_left & np.roll(shallow, 1)) | (has_right & np.roll(shallow, -1))
+        merge = shallow & ~(lowest & waiting)
+        keep = ~merge
+        apex = np.maximum.reduceat(apex, np.flatnonzero(np.concatenate(([True], keep))))
+        starts = starts[np.concatenate(([True], keep))]
+        hard, valley = hard[keep], valley[keep]
+    summed = np.add.reduceat(intensity, starts)
+    return np.add.reduceat(mz * intensity, starts) / summed, np.maximum.reduceat(intensity, starts)
 
 
 class QueryTargetedSpectrum:
@@ -15,160 +328,187 @@ class QueryTargetedSpectrum:
     read how many scans in a specific input file,
     label all spectra in the real-time library and name it as target spectrum"""
 
-    def __init__(self, filepath,intensity_threshold=3000):
+    def __init__(self, filepath,intensity_threshold=3000, scan_cache_size=8, candidate_cache=None, preprocessing=None):
         
         self.filepath = filepath
         _, file_extension = os.path.splitext(filepath)
         self.intensity_threshold = intensity_threshold
+        self.preprocessing = preprocessing   # QueryPreprocessing of the query spectra, None: intensity_threshold only
         
+        # the pyteomics readers are imported on first use, they are slow to import
         if file_extension.lower() == '.mzml':
+            from pyteomics import mzml
             self.file_type = 'mzml'
-            self.tmp = pyteomics.mzml.read(filepath, use_index=True)
+            self.tmp = mzml.read(filepath, use_index=True)
         elif file_extension.lower() == '.mzxml':
+            from pyteomics import mzxml
             self.file_type = 'mzxml'
-            self.tmp = pyteomics.mzxml.read(filepath, use_index=True)
+            self.tmp = mzxml.read(filepath, use_index=True)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
 
-            
-    def get_query_spectrum(self, scan) -> list:
-        if self.file_type == 'mzml':
-            return self._get_query_spectrum_mzml(scan)
-        elif self.file_type == 'mzxml':
-            return self._get_query_spectrum_mzxml(scan)
-    
-    def _get_query_spectrum_mzml(self, scan) -> list:
-        # Implementation for mzML files
-        ms_level = self.tmp.get_by_index(scan)['ms level']
-        mzs, intens, label = [], [], []
-
-        if ms_level == 2:
-            mz = self.tmp.get_by_index(scan)['m/z array']
-            inten = self.tmp.get_by_index(scan)['intensity array']
-            filter_mz_inten = [(x, y) for x, y in zip(mz, inten) if y > self.intensity_threshold]   # filter the input spectrum intensity 
-            if filter_mz_inten:
-                mzs, intens = zip(*filter_mz_inten)
-            else:
-                mzs, intens = [], []
-            label = [str(scan)] * len(mzs)
-        else:
-            label = []
-
-        return list(zip(mzs, intens, label))
-
-    def _get_query_spectrum_mzxml(self, scan) -> list:
-        ms_level = self.tmp[scan]['msLevel']
-        mzs, intens, label = [], [], []
-
-        if ms_level == 2:
-            mz = self.tmp[scan]['m/z array']
-            inten = self.tmp[scan]['intensity array']
-            filter_mz_inten = [(x, y) for x, y in zip(mz, inten) if y > self.intensity_threshold]  # filter the input spectrum intensity 
-            if filter_mz_inten:
-                mzs, intens = zip(*filter_mz_inten)
-            else:
-                mzs, intens = [], []
-            label = [str(scan)] * len(mzs)
-        else:
-            label = []
+        self._library_index = None
+        self.scan_cache_size = scan_cache_size
+        self._scan_cache = OrderedDict()   # scan index -> ScanRecord, least recently used first
+        self._scan_table = None
+        # candidates per isolation window, can be shared between files searched against the same LibraryIndex
+        self.candidate_cache = candidate_cache if candidate_cache is not None else CandidateCache()
 
-        return list(zip(mzs, intens, label))
 
-    
-    def get_realtime_lib(self, scan, library, PIMT) -> list:
+    def get_scan_record(self, scan) -> ScanRecord:
+        """decoded scan from the LRU cache, the input file is only read on a cache miss"""
+        record = self._scan_cache.get(scan)
+        if record is not None:
+            self._scan_cache.move_to_end(scan)
+            return record
+
         if self.file_type == 'mzml':
-            return self._get_realtime_lib_mzml(scan, library, PIMT)
+            record = self._read_scan_mzml(scan)
         elif self.file_type == 'mzxml':
-            return self._get_realtime_lib_mzxml(scan, library, PIMT)
+            record = self._read_scan_mzxml(scan)
+
+        self._scan_cache[scan] = record
+        if len(self._scan_cache) > self.scan_cache_size:
+            self._scan_cache.popitem(last=False)
+        return record
+
+    def _read_scan_mzml(self, scan) -> ScanRecord:
+        spectrum = self.tmp.get_by_index(scan)
+        return ScanRecord(spectrum['ms level'], spectrum['m/z array'], spectrum['intensity array'], *self._scan_header_mzml(spectrum))
+
+    def _read_scan_mzxml(self, scan) -> ScanRecord:
+        spectrum = self.tmp.get_by_index(scan)
+        return ScanRecord(spectrum['msLevel'], spectrum['m/z array'], spectrum['intensity array'], *self._scan_header_mzxml(spectrum))
+
+    @staticmethod
+    def _scan_header_mzml(spectrum) -> tuple:
+        precursor = float(spectrum['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z']
+                if 'precursorList' in spectrum else 'Nan')
+        comp_vol = float(spectrum['FAIMS compensation voltage'] if 'FAIMS compensation voltage' in spectrum else 'Nan')
+        return precursor, comp_vol
+
+    @staticmethod
+    def _scan_header_mzxml(spectrum) -> tuple:
+        precursor = float(spectrum['precursorMz'][0]['precursorMz'] if 'precursorMz' in spectrum else 'Nan')
+        comp_vol = float(spectrum['compensationVoltage'] if 'compensationVoltage' in spectrum else 'Nan')
+        return precursor, comp_vol
+
             
+    def get_query_peaks(self, scan) -> PeakArrays:
+        """query spectrum of an MS2 scan as arrays, peaks at or below intensity_threshold are masked out
+        and the preprocessing, if any, is applied"""
+        record = self.get_scan_record(scan)
 
-    def _get_realtime_lib_mzml(self, scan, library, PIMT) -> list:
-        
-        ms_level = self.tmp.get_by_index(scan)['ms level']
-        
-        realtime_lib = []
-        
-        if ms_level == 2:
-            precursor = float(self.tmp.get_by_index(scan)['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z'])
-            realtime_lib = [item for item in library if (precursor - PIMT < float(item['precursormz']) < precursor + PIMT)]
-        
-        return realtime_lib
+        if record.ms_level == 2:
+            if self.preprocessing is not None:
+                return PeakArrays(*self.preprocessing.apply(record.mz, record.intensity, self.intensity_threshold), str(scan))
+            mz, inten = np.asarray(record.mz), np.asarray(record.intensity)
+            keep = inten > self.intensity_threshold   # filter the input spectrum intensity 
+            return PeakArrays(mz[keep], inten[keep], str(scan))
+
+        return PeakArrays(np.empty(0), np.empty(0), str(scan))
+
+    def get_consensus_peaks(self, scans, ppm_tolerance, mode='sum') -> PeakArrays:
+        """query spectra of several MS2 scans merged into one consensus spectrum (see merge_peaks), labelled with the first scan"""
+        return merge_peaks([self.get_query_peaks(scan) for scan in scans], ppm_tolerance, mode=mode, label=str(scans[0]))
+
+    def get_query_spectrum(self, scan) -> list:
+        peaks = self.get_query_peaks(scan)
+        return list(zip(peaks.mz, peaks.intensity, [peaks.label] * len(peaks)))
 
-    def _get_realtime_lib_mzxml(self, scan, library, PIMT) -> list:
+    
+    def get_realtime_lib(self, scan, library, PIMT) -> list:
         
         '''Library should be reformatted by the DIMA LibraryReformatted class and define the maximum peaks in each library mass spectrum,
-        PIMT: Precursor Ion Mass Tolerance, defines mass tolerance for MS1 '''
+        PIMT: Precursor Ion Mass Tolerance, defines mass tolerance for MS1,
+        library can be a list of spectra or a LibraryIndex built from it '''
         
-        ms_level = self.tmp[scan]['msLevel']
+        library = self._get_library_index(library)
+        record = self.get_scan_record(scan)
         
         realtime_lib = []
-        if ms_level == 2:
-            precursor = float(self.tmp[scan]['precursorMz'][0]['precursorMz'])
-            realtime_lib = [item for item in library if (precursor - PIMT < float(item['precursormz']) < precursor + PIMT)]
+        if record.ms_level == 2:
+            realtime_lib = list(self.candidate_cache.get(library, record.precursor, PIMT).entries())
         
         return realtime_lib
+
+    def _get_library_index(self, library) -> LibraryIndex:
+        """wrap a plain library list into a LibraryIndex, built once and reused for the following scans"""
+        if isinstance(library, LibraryIndex):
+            return library
+        if self._library_index is None or self._library_index.library is not library:
+            self._library_index = LibraryIndex(library)
+        return self._library_index
     
     
-    def get_scans(self):
-        if self.file_type == 'mzml':
-            return self._countscans_mzml()
-        elif self.file_type == 'mzxml':
-            return self._countscans_mzxml()
-    
-    def _countscans_mzml(self)->int:
-        # Initialize a counter
-        scan_count = 0
-        # Read the .mzML file and iterate over its contents
-        for spectrum in self.tmp:
-        # Increment the counter for each spectrum found
-            scan_count += 1
-        return scan_count
-
-    def _countscans_mzxml(self)->int:
-        # Initialize a counter
-        scan_count = 0
-        # Read the .mzXML file and iterate over its contents
-        for spectrum in self.tmp:
-        # Increment the counter for each spectrum found
-            scan_count += 1
-        return scan_count
-    
-    
-    def get_precusorMZ(self,scan):
-        if self.file_type == 'mzml':
-            return self._getprecusor_mzml(scan)
-        elif self.file_type == 'mzxml':
-            return self._getprecusor_mzxml(scan)
+    def get_scans(self)->int:
+        """number of scans in the input file, taken from the offset index of the reader"""
+        return len(self.tmp)
+
+    def get_scan_table(self) -> dict:
+        """
+        per scan metadata of the whole file from a header-only pass, binary arrays are not decoded.
+
+        :return: dict of arrays indexed by scan index: 'ms_level', 'precursor' (isolation target, nan for MS1)
+                 and 'compensation_voltage' (nan without FAIMS)
+        """
+        if self._scan_table is None:
+            if self.file_type == 'mzml':
+                from pyteomics import mzml
+                headers = mzml.read(self.filepath, decode_binary=False)
+                level_key, header = 'ms level', self._scan_header_mzml
+            elif self.file_type == 'mzxml':
+                from pyteomics import mzxml
+                headers = mzxml.read(self.filepath, decode_binary=False)
+                level_key, header = 'msLevel', self._scan_header_mzxml
+            ms_levels, precursors, comp_vols = [], [], []
+            with headers:
+                for spectrum in headers:
+                    precursor, comp_vol = header(spectrum)
+                    ms_levels.append(spectrum[level_key])
+                    precursors.append(precursor)
+                    comp_vols.append(comp_vol)
+            self._scan_table = {'ms_level': np.asarray(ms_levels, dtype=np.int64),
+                                'precursor': np.asarray(precursors, dtype=np.float64),
+                                'compensation_voltage': np.asarray(comp_vols, dtype=np.float64)}
+        return self._scan_table
+
+    def group_scans(self, lowerscan=0, higherscan=None) -> list:
+        """
+        MS2 scans in range(lowerscan, higherscan) grouped by (isolation target, compensation voltage),
+        DI-MS acquires the same windows in every cycle so each group holds the replicate scans of one window.
+
+        :return: list of (precursor, compensation voltage, array of scan indices), ordered by the first scan of each group
+        """
+        table = self.get_scan_table()
+        if higherscan is None:
+            higherscan = len(table['ms_level'])
+        groups = {}
+        for scan in range(lowerscan, higherscan):
+            if table['ms_level'][scan] != 2:
+                continue
+            precursor, comp_vol = table['precursor'][scan], table['compensation_voltage'][scan]
+            key = (None if np.isnan(precursor) else float(precursor), None if np.isnan(comp_vol) else float(comp_vol))
+            groups.setdefault(key, []).append(scan)
+        return [(table['precursor'][scans[0]], table['compensation_voltage'][scans[0]], np.asarray(scans, dtype=np.intp))
+                for scans in groups.values()]
+
+    def get_ms_level(self, scan)->int:
+        return int(self.get_scan_table()['ms_level'][scan])
+
+    def get_ms2_scan_range(self) -> tuple:
+        """(first, last) index of the MS2 scans in the file, None when there are no MS2 scans"""
+        ms2_scans = np.flatnonzero(self.get_scan_table()['ms_level'] == 2)
+        if not len(ms2_scans):
+            return None
+        return int(ms2_scans[0]), int(ms2_scans[-1])
     
-    def _getprecusor_mzml(self,scan)->float:
-        # Initialize a counter
-        precusormz= float(self.tmp.get_by_index(scan)['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z']
-                if 'precursorList' in self.tmp.get_by_index(scan) else 'Nan')
-        return precusormz
-
-    def _getprecusor_mzxml(self,scan)->float:
-        
-        precusormz= float(self.tmp.get_by_index(scan)['precursorMz'][0]['precursorMz']
-                if 'precursorMz' in self.tmp.get_by_index(scan) else 'Nan')
-        return precusormz
     
-    def get_compensation_voltage(self,scan):
-        
-        if self.file_type == 'mzml':
-            return self._get_compensation_voltage_mzml(scan)
-        
-        elif self.file_type == 'mzxml':
-            return self._get_compensation_voltage_mzxml(scan)
+    def get_precusorMZ(self,scan)->float:
+        return self.get_scan_record(scan).precursor
     
-    def _get_compensation_voltage_mzml(self,scan)->str:
-        
-        comp_vol = float(self.tmp.get_by_index(scan)['FAIMS compensation voltage'] if 'FAIMS compensation voltage' in self.tmp.get_by_index(scan) else 'Nan')
-        return comp_vol
-
-    def _get_compensation_voltage_mzxml(self,scan)->str:
-        
-        comp_vol= float(self.tmp.get_by_index(scan)['compensationVoltage'] if 'compensationVoltage' in self.tmp.get_by_index(scan) else 'Nan')
-        return comp_vol
+    def get_compensation_voltage(self,scan)->float:
+        return self.get_scan_record(scan).compensation_voltage
     
       
     def get_target_spectrum(self, scan, library, PIMT) -> list:
@@ -179,10 +519,49 @@ class QueryTargetedSpectrum:
             target_spectrum.extend(list(zip(real[i]['mz'], real[i]['intensity'], [str(i)] * len(real[i]['mz']))))
         return sorted(target_spectrum, key=lambda x: x[0])
 
+    def get_target_peaks(self, scan, library, PIMT) -> PeakArrays:
+        """all peaks of the real-time library as arrays sorted by m/z, labelled with the position of their spectrum in the real-time library"""
+        library = self._get_library_index(library)
+        record = self.get_scan_record(scan)
+        if record.ms_level != 2:
+            return library.target_peaks(np.empty(0, dtype=np.intp))
+        return self.candidate_cache.get(library, record.precursor, PIMT).peaks()
+
 
     
     
 
+def merge_peaks(peak_arrays, ppm_tolerance, mode='sum', label=None) -> PeakArrays:
+    """
+    Merge the peak lists of replicate scans into one consensus spectrum.
+    All peaks are sorted by m/z and consecutive peaks within ppm_tolerance of each other are put into the same bin,
+    the bin m/z is the intensity weighted mean m/z and the bin intensity the summed intensity ('sum')
+    or the summed intensity divided by the number of peak lists ('mean').
+    """
+    if mode not in ('sum', 'mean'):
+        raise ValueError(f"Unsupported merge mode: {mode}")
+    if not peak_arrays:
+        return PeakArrays(np.empty(0), np.empty(0), label)
+    mz = np.concatenate([np.asarray(peaks.mz, dtype=np.float64) for peaks in peak_arrays])
+    intensity = np.concatenate([np.asarray(peaks.intensity, dtype=np.float64) for peaks in peak_arrays])
+    if len(mz) == 0:
+        return PeakArrays(mz, intensity, label)
+
+    order = np.argsort(mz, kind='stable')
+    mz, intensity = mz[order], intensity[order]
+    new_bin = np.diff(mz) > ppm_tolerance * 1e-6 * mz[:-1]
+    bins = np.concatenate(([0], np.cumsum(new_bin)))
+    summed = np.bincount(bins, intensity)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        consensus_mz = np.bincount(bins, mz * intensity) / summed
+    empty = summed == 0   # bins of zero intensity peaks keep their plain mean m/z
+    if np.any(empty):
+        consensus_mz[empty] = (np.bincount(bins, mz) / np.bincount(bins))[empty]
+    if mode == 'mean':
+        summed = summed / len(peak_arrays)
+    return PeakArrays(consensus_mz, summed, label)
+
+
 def within_tolerance_ppm(mz1, mz2, ppm):
     """ Check if mz2 is within the "ppm" tolerance of mz1. """
     tolerance = mz1 * ppm / 1e6
@@ -196,22 +575,61 @@ def within_tolerance_da(mz1, mz2, da):
 def match_spectrum(query_spectrum, target_spectrum, ppm_tolerance):
     """
     Match a spectrum to a query spectrum within a given PPM tolerance and return the matched peaks along with their three-dimensional values.
+    Target peaks are sorted by m/z once and the ppm window of every query peak is located with searchsorted on both bounds,
+    so only the peaks inside the window are compared instead of the full query x target product.
     
-    :param query_spectrum: List of (m/z, intensity, value) tuples for the query spectrum.
-    :param target_spectrum: List of (m/z, intensity, value) tuples for the target spectrum.
+    :param query_spectrum: List of (m/z, intensity, value) tuples for the query spectrum, or PeakArrays.
+    :param target_spectrum: List of (m/z, intensity, value) tuples for the target spectrum, or PeakArrays.
     :param ppm_tolerance: PPM tolerance for matching.
-    :return: Matched peaks as a list of tuples (query_mz, query_intensity, query_value, target_mz, target_intensity, target_value).
+    :return: Matched peaks as a list of tuples (query_mz, query_intensity, query_value, target_mz, target_intensity, target_value),
+             MatchedPeaks with the same rows for PeakArrays input.
     """
+    if isinstance(query_spectrum, PeakArrays):
+        return _match_peak_arrays(query_spectrum, target_spectrum, ppm_tolerance)
+
     matches = []
-    for query_mz, query_intensity, query_label in query_spectrum:
-        for target_mz, target_intensity, target_label in target_spectrum:
+    if not len(query_spectrum) or not len(target_spectrum):
+        return matches
+
+    query_mzs = np.asarray([peak[0] for peak in query_spectrum], dtype=np.float64)
+    target_mzs = np.asarray([peak[0] for peak in target_spectrum], dtype=np.float64)
+    target_order = np.argsort(target_mzs, kind='stable')
+    sorted_target_mz = target_mzs[target_order]
+
+    # the search window is widened slightly, the exact tolerance test below decides on the matches
+    tolerance = np.abs(query_mzs * ppm_tolerance / 1e6)
+    margin = tolerance * 1e-6 + np.abs(query_mzs) * 1e-6
+    lower = np.searchsorted(sorted_target_mz, query_mzs - tolerance - margin, side='left')
+    upper = np.searchsorted(sorted_target_mz, query_mzs + tolerance + margin, side='right')
+
+    for i in np.flatnonzero(upper > lower):
+        query_mz, query_intensity, query_label = query_spectrum[i]
+        for j in np.sort(target_order[lower[i]:upper[i]]):   # keep the target order of the full comparison
+            target_mz, target_intensity, target_label = target_spectrum[j]
             if within_tolerance_ppm(query_mz, target_mz, ppm_tolerance):
                 matches.append((query_mz, query_intensity, query_label,target_mz, target_intensity, target_label))
-                #break  # Assuming only one match per query peak
-            #if within_tolerance_da(query_mz, target_mz, da):
-                #matches.append((query_mz, query_intensity, query_label, target_mz, target_intensity, target_label)) 
     return matches
 
+def _match_peak_arrays(query, target, ppm_tolerance) -> MatchedPeaks:
+    """match_spectrum on PeakArrays, every query/target pair inside the ppm window is found without leaving NumPy"""
+    target_order = np.argsort(target.mz, kind='stable')
+    sorted_target_mz = target.mz[target_order]
+    tolerance = query.mz * ppm_tolerance / 1e6
+    margin = np.abs(tolerance) * 1e-6 + np.abs(query.mz) * 1e-6
+    lower = np.searchsorted(sorted_target_mz, query.mz - np.abs(tolerance) - margin, side='left')
+    upper = np.searchsorted(sorted_target_mz, query.mz + np.abs(tolerance) + margin, side='right')
+
+    # expand the windows into (query, target) candidate pairs
+    counts = upper - lower
+    query_index = np.repeat(np.arange(len(query.mz)), counts)
+    starts = np.repeat(lower - np.cumsum(counts) + counts, counts)
+    target_index = target_order[starts + np.arange(len(query_index))]
+
+    hit = np.abs(query.mz[query_index] - target.mz[target_index]) <= tolerance[query_index]
+    query_index, target_index = query_index[hit], target_index[hit]
+    rows = np.lexsort((target_index, query_index))   # query order first, then the target order of the full comparison
+    return MatchedPeaks(query, target, query_index[rows], target_index[rows])
+
 def cosine_similarity(vector1, vector2):
     """
     Calculate the cosine similarity between two vectors.
@@ -243,9 +661,13 @@ def group_tuples_by_same_value(tuples_list,same_value_position):
     """
     Groups tuples in the provided list by their last value.
 
-    :param tuples_list: List of tuples.
-    :return: List of lists, where each sublist contains tuples with the same last value(label).
+    :param tuples_list: List of tuples, or MatchedPeaks.
+    :return: List of lists, where each sublist contains tuples with the same last value(label),
+             a list of MatchedPeaks for MatchedPeaks input.
     """
+    if isinstance(tuples_list, MatchedPeaks):
+        return [tuples_list.take(rows) for rows in _group_positions(tuples_list.column(same_value_position))]
+
     grouped_tuples = {}
     for t in tuples_list:
         key = t[same_value_position]  # Last element of the tuple
@@ -255,7 +677,7 @@ def group_tuples_by_same_value(tuples_list,same_value_position):
 
 def normalize_to_100(numbers):
     """normalize the spectrum to 0 to 100"""
-    if not numbers or max(numbers) == 0:
+    if len(numbers) == 0 or max(numbers) == 0:
         return [0] * len(numbers)
 
     max_value = max(numbers)
@@ -267,11 +689,16 @@ def filter_tuples(tuples)->list:
     and for each unique fourth value, keeps the tuple with the highest second value.
 
     Parameters:
-    - tuples: A list of tuples, where each tuple has at least four elements.
+    - tuples: A list of tuples, where each tuple has at least four elements, or MatchedPeaks.
 
     Returns:
-    - A list of filtered tuples.
+    - A list of filtered tuples, MatchedPeaks for MatchedPeaks input.
     """   
+    if isinstance(tuples, MatchedPeaks):
+        # same two steps on the columns, ties keep the first row like the dict version
+        by_fourth = tuples.take(_first_max_by_key(tuples.target_mz, tuples.query_intensity))
+        return by_fourth.take(_first_max_by_key(by_fourth.query_mz, by_fourth.query_intensity))
+
     # Step 1: Filter based on the fourth value, choosing the tuple with the highest second value
     max_second_by_fourth = defaultdict(lambda: (None, float('-inf'), None, None))
     for t in tuples:
@@ -293,5 +720,88 @@ def filter_tuples(tuples)->list:
     return final_tuples
 
 
-
-
+def _group_positions(keys) -> list:
+    """positions of equal keys grouped together, groups in order of first appearance"""
+    if not len(keys):
+        return []
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+    return [groups[g] for g in np.argsort(first, kind='stable')]
+
+def _first_max_by_key(keys, values) -> np.ndarray:
+    """for every distinct key the position of its largest value (first one on ties), in order of first appearance of the key,
+    keys is an array or a tuple of arrays forming a composite key"""
+    key_columns = keys if isinstance(keys, tuple) else (keys,)
+    if not len(values):
+        return np.empty(0, dtype=np.intp)
+    positions = np.arange(len(values))
+    order = np.lexsort((positions, -values) + key_columns[::-1])
+    new_key = np.zeros(len(order), dtype=bool)
+    new_key[0] = True
+    for column in key_columns:
+        sorted_column = column[order]
+        new_key[1:] |= sorted_column[1:] != sorted_column[:-1]
+    starts = np.flatnonzero(new_key)
+    first = np.minimum.reduceat(order, starts)
+    return order[starts][np.argsort(first, kind='stable')]
+
+
+class CandidateScores:
+    """scores of all candidates of one scan, one array entry per library candidate with enough matched peaks"""
+
+    def __init__(self, labels, cosine, matched_peaks, matches, offsets):
+        self.labels = labels                  # candidate position in the real-time library
+        self.cosine = cosine
+        self.matched_peaks = matched_peaks    # number of matched peaks left after filter_tuples
+        self.macc = macc_score(matched_peaks, cosine)
+        self.matches = matches                # filtered MatchedPeaks of all candidates, grouped by candidate
+        self.offsets = offsets                # rows of candidate i are matches[offsets[i]:offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def candidate_matches(self, i) -> MatchedPeaks:
+        return self.matches.take(np.arange(self.offsets[i], self.offsets[i + 1]))
+
+
+def score_candidates(matched_peaks, minmatchedpeaks=1) -> CandidateScores:
+    """
+    Score every library candidate of a scan in one vectorized pass.
+    The matched peaks of all candidates are treated as one sparse candidate x fragment matrix: filter_tuples runs on
+    composite (candidate, m/z) keys for all candidates at once and the cosine numerators and norms are per candidate sums
+    (np.bincount) over the filtered rows. Candidates come out in the order of group_tuples_by_same_value(matched_peaks, -1)
+    with the same filtered peaks; cosine values agree with cosine_similarity up to floating point summation order.
+
+    :param matched_peaks: MatchedPeaks of a query against the target peaks of all candidates.
+    :param minmatchedpeaks: candidates with fewer filtered matched peaks are dropped.
+    """
+    labels = matched_peaks.target_label
+    # rank of every candidate by first appearance, the group order of group_tuples_by_same_value
+    unique_labels, first_rows, label_rank = np.unique(labels, return_index=True, return_inverse=True)
+    group_rank = np.empty(len(unique_labels), dtype=np.intp)
+    group_rank[np.argsort(first_rows, kind='stable')] = np.arange(len(unique_labels))
+    row_group = group_rank[label_rank.reshape(-1)] if len(labels) else np.empty(0, dtype=np.intp)
+
+    # filter_tuples for all candidates at once: best query peak per (candidate, target m/z), then per (candidate, query m/z)
+    step1 = _first_max_by_key((row_group, matched_peaks.target_mz), matched_peaks.query_intensity)
+    step2 = step1[_first_max_by_key((row_group[step1], matched_peaks.query_mz[step1]), matched_peaks.query_intensity[step1])]
+    rows = step2[np.argsort(row_group[step2], kind='stable')]
+    filtered = matched_peaks.take(rows)
+    groups = row_group[rows]
+
+    n_groups = len(unique_labels)
+    counts = np.bincount(groups, minlength=n_groups)
+    query_intensity, target_intensity = filtered.query_intensity, filtered.target_intensity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine = np.bincount(groups, query_intensity * target_intensity, minlength=n_groups) / (
+            np.sqrt(np.bincount(groups, query_intensity * query_intensity, minlength=n_groups)) *
+            np.sqrt(np.bincount(groups, target_intensity * target_intensity, minlength=n_groups)))
+
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    keep = np.flatnonzero(counts >= minmatchedpeaks)
+    kept_rows = np.concatenate([np.arange(offsets[g], offsets[g + 1]) for g in keep]) if len(keep) else np.empty(0, dtype=np.intp)
+    group_labels = np.empty(n_groups, dtype=unique_labels.dtype)
+    group_labels[group_rank] = unique_labels
+    return CandidateScores(group_labels[keep], cosine[keep], counts[keep], filtered.take(kept_rows),
+                           np.concatenate(([0], np.cumsum(counts[keep]))))
@@ -1,57 +1,388 @@
 
-import numpy as np 
+import numpy as np
 import pandas as pd
 import os
+import json
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from result_writer import read_result_file
+from progress import ProgressReporter, check_cancel
+from run_manifest import _atomic_write
 
 
+# dtypes of the columns read for the quantification, given to the reader so no type inference is needed
+QUANTITY_DTYPES = {'PrecursorMZ': 'float64', 'Compensation Voltage': 'float64', 'Ion_count': 'float64'}
+# record of the tables save_final_df wrote into a folder, they are never read back as identification results
+OUTPUTS_FILENAME = 'dimeta_outputs.json'
+
+
+def side_table_filename(output_filename, table) -> str:
+    '''file name of a table written next to the merged table, e.g. merged_output_mapping.csv for the mapping'''
+    stem, extension = os.path.splitext(output_filename)
+    return f"{stem}_{table}{extension}"
+
+
+def written_outputs(folder_path) -> set:
+    '''file names of the tables save_final_df wrote into folder_path'''
+    try:
+        with open(os.path.join(folder_path, OUTPUTS_FILENAME), 'r', encoding='utf-8') as file:
+            return set(json.load(file))
+    except (OSError, ValueError):
+        return set()
+
+
+def read_quantities(file_path, round_precursor=True):
+    '''Quantities of one result file like reformat_df, as arrays (precursor code, compensation voltage, ion count):
+    one row per label with its highest Ion_count, rows by decreasing Ion_count. The precursor code is PrecursorMZ
+    rounded to 2 decimals times 100, without round_precursor the PrecursorMZ itself (the rows of align_features).
+    Returns None when the file is not an identification result'''
+    try:
+        df = read_result_file(file_path, columns=Meta_df_Merge.required_columns, dtype=QUANTITY_DTYPES)
+    except (ValueError, KeyError):
+        return None   # not an identification result
+    precursor_code = df['PrecursorMZ'].to_numpy(dtype=np.float64)
+    if round_precursor:
+        precursor_code = np.rint(precursor_code * 100)   # as np.round(PrecursorMZ, 2)
+    compensation_voltage = df['Compensation Voltage'].to_numpy(dtype=np.float64)
+    ion_count = df['Ion_count'].to_numpy(dtype=np.float64)
+
+    order = np.argsort(-ion_count, kind='stable')
+    keys = pd.DataFrame({'precursor': precursor_code[order], 'cv': compensation_voltage[order]})
+    first = order[~keys.duplicated().to_numpy()]
+    return precursor_code[first], compensation_voltage[first], ion_count[first]
+
+
+# identification columns carried by read_identifications, the best identification of a feature is the one of highest Macc_score
+IDENTIFICATION_COLUMNS = ['Compound', 'Adduct', 'Formula', 'CompoundMZ', 'Cosine_score', 'Macc_score', 'Matched_peaks']
+
+
+def _best_rows(group, score, n_groups) -> np.ndarray:
+    '''per group id 0..n_groups-1 the row of the highest score (the first row for equal scores, missing scores last)'''
+    order = np.lexsort((-score, group))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.diff(group[order]) != 0
+    return order[first][:n_groups]
+
+
+def read_identifications(file_path):
+    '''read_quantities (without round_precursor) of one result file together with its identifications:
+    ((PrecursorMZ, compensation voltage, ion count), {identification column: values}), per distinct
+    (PrecursorMZ, compensation voltage) the highest Ion_count and the identification of highest Macc_score.
+    Returns None when the file is not an identification result'''
+    try:
+        df = read_result_file(file_path, columns=Meta_df_Merge.required_columns + IDENTIFICATION_COLUMNS,
+                              dtype={**QUANTITY_DTYPES, 'Cosine_score': 'float64', 'Macc_score': 'float64', 'CompoundMZ': 'float64'})
+    except (ValueError, KeyError):
+        return None   # not an identification result
+    precursor = df['PrecursorMZ'].to_numpy(dtype=np.float64)
+    compensation_voltage = df['Compensation Voltage'].to_numpy(dtype=np.float64)
+    ion_count = df['Ion_count'].to_numpy(dtype=np.float64)
+    group = pd.DataFrame({'precursor': precursor, 'cv': compensation_voltage}).groupby(
+        ['precursor', 'cv'], sort=False, dropna=False).ngroup().to_numpy()
+    n_groups = int(group.max()) + 1 if len(group) else 0
+
+    quantity_rows = _best_rows(group, ion_count, n_groups)
+    identification_rows = _best_rows(group, df['Macc_score'].to_numpy(dtype=np.float64), n_groups)
+    quantities = (precursor[quantity_rows], compensation_voltage[quantity_rows], ion_count[quantity_rows])
+    return quantities, {column: df[column].to_numpy()[identification_rows] for column in IDENTIFICATION_COLUMNS}
+
+
+class QuantMatrix:
+    '''
+    Feature x sample matrix of ion counts, kept sparse: per sample the integer codes of its labels (rows of labels)
+    and their ion counts. to_wide gives the table of merge_dfs, to_long one row per measured (label, sample).
+    '''
+
+    def __init__(self, labels, samples, label_codes, ion_counts):
+        self.labels = labels
+        self.samples = samples
+        self.label_codes = label_codes   # per sample, int32 positions in labels
+        self.ion_counts = ion_counts     # per sample, float64
+
+    def __len__(self):
+        return len(self.labels)
+
+    def to_wide(self) -> pd.DataFrame:
+        '''labels x samples, NaN where a sample has no value'''
+        values = np.full((len(self.labels), len(self.samples)), np.nan)
+        for j, (codes, counts) in enumerate(zip(self.label_codes, self.ion_counts)):
+            values[codes, j] = counts
+        return pd.DataFrame(values, index=pd.Index(self.labels, name='label'), columns=list(self.samples))
+
+    def to_long(self) -> pd.DataFrame:
+        '''columns label, sample and Ion_count (label and sample categorical), missing values are left out'''
+        codes = np.concatenate(self.label_codes) if self.label_codes else np.empty(0, dtype=np.int32)
+        counts = np.concatenate(self.ion_counts) if self.ion_counts else np.empty(0)
+        sample_codes = np.repeat(np.arange(len(self.samples), dtype=np.int32), [len(c) for c in self.label_codes])
+        present = ~np.isnan(counts)
+        return pd.DataFrame({'label': pd.Categorical.from_codes(codes[present], categories=self.labels),
+                             'sample': pd.Categorical.from_codes(sample_codes[present], categories=list(self.samples)),
+                             'Ion_count': counts[present]})
+
+
+def build_matrix(samples, quantities) -> QuantMatrix:
+    '''QuantMatrix of the read_quantities results of samples, labels integer coded in order of first appearance'''
+    keys = pd.DataFrame({'precursor': np.concatenate([q[0] for q in quantities]),
+                         'cv': np.concatenate([q[1] for q in quantities])})
+    codes = keys.groupby(['precursor', 'cv'], sort=False, dropna=False).ngroup().to_numpy().astype(np.int32)
+    first = np.unique(codes, return_index=True)[1]
+    labels = [f"{precursor / 100}_{cv}" for precursor, cv in zip(keys['precursor'].to_numpy()[first].tolist(),
+                                                                 keys['cv'].to_numpy()[first].tolist())]
+    split = np.cumsum([len(q[0]) for q in quantities])[:-1]
+    return QuantMatrix(labels, list(samples), np.split(codes, split), [q[2] for q in quantities])
+
+
+def iter_quantities(paths, n_workers, reader=read_quantities):
+    '''reader (read_quantities or read_identifications) of each path in order, with n_workers > 1 read by a pool of processes'''
+    if n_workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield reader(path)
+        return
+    executor = ProcessPoolExecutor(max_workers=min(n_workers, len(paths)))
+    try:
+        yield from executor.map(reader, paths)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _group_starts(values, tolerance) -> np.ndarray:
+    '''mask of the sorted values starting a group: the step to the previous value exceeds tolerance (an array of
+    per value tolerances or a scalar), missing values form a group of their own'''
+    missing = np.isnan(values)
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = (np.diff(values) > tolerance) | (missing[1:] != missing[:-1])
+    return starts
+
+
+class FeatureAlignment:
+    '''
+    Result of align_features.
+    features: consensus features indexed by label (consensus m/z to 4 decimals _ compensation voltage), with the
+    consensus PrecursorMZ (Ion_count weighted mean), Compensation Voltage, mz_min, mz_max and n_samples.
+    mapping: the sample-level rows (sample, PrecursorMZ, Compensation Voltage, Ion_count) with their feature label.
+    matrix: QuantMatrix of the features, a sample with several rows in a feature keeps the highest Ion_count.
+    identifications: when aligned with identifications, the best identification (highest Macc_score over all
+    samples) of every feature indexed by label, with its sample, else None.
+    '''
+
+    def __init__(self, features, mapping, matrix, identifications=None):
+        self.features = features
+        self.mapping = mapping
+        self.matrix = matrix
+        self.identifications = identifications
+
+    def __len__(self):
+        return len(self.features)
+
+    def feature_table(self) -> pd.DataFrame:
+        '''consensus features with one column of ion counts per sample'''
+        return self.features.join(self.matrix.to_wide())
+
+    def compound_table(self) -> pd.DataFrame:
+        '''
+        Tidy compound level quantification: one row per feature and sample with a measured Ion_count, carrying the
+        best identification of the feature (Compound, Adduct, Formula, CompoundMZ, scores and the sample it was made in),
+        the consensus PrecursorMZ and Compensation Voltage. Rows are ordered by feature, then sample.
+        '''
+        if self.identifications is None:
+            raise ValueError("features were aligned without identifications")
+        codes = np.concatenate(self.matrix.label_codes)
+        sample_codes = np.repeat(np.arange(len(self.matrix.samples), dtype=np.int32), [len(c) for c in self.matrix.label_codes])
+        counts = np.concatenate(self.matrix.ion_counts)
+        present = ~np.isnan(counts)
+        order = np.lexsort((sample_codes[present], codes[present]))
+        codes, sample_codes, counts = codes[present][order], sample_codes[present][order], counts[present][order]
+
+        table = {column: self.identifications[column].to_numpy()[codes] for column in IDENTIFICATION_COLUMNS}
+        table['identified_in'] = self.identifications['identified_in'].to_numpy()[codes]
+        table['feature'] = pd.Categorical.from_codes(codes, categories=self.features.index)
+        table['PrecursorMZ'] = self.features['PrecursorMZ'].to_numpy()[codes]
+        table['Compensation Voltage'] = self.features['Compensation Voltage'].to_numpy()[codes]
+        table['sample'] = pd.Categorical.from_codes(sample_codes, categories=list(self.matrix.samples))
+        table['Ion_count'] = counts
+        return pd.DataFrame(table)
+
+
+def align_features(samples, quantities, ppm_tolerance, cv_tolerance=0.0, identifications=None) -> FeatureAlignment:
+    '''
+    Align the rows of samples (read_quantities results without round_precursor) into consensus features,
+    identifications are the optional per sample identification columns of the rows (see read_identifications).
+    Rows are grouped by compensation voltage (consecutive sorted CVs at most cv_tolerance apart, 0 for equal CVs),
+    within a group sorted by m/z and swept once: consecutive rows within ppm_tolerance of each other belong to
+    the same feature, as the bins of merge_peaks. Sorting is the only superlinear step.
+    '''
+    sample_index = np.repeat(np.arange(len(samples)), [len(q[0]) for q in quantities])
+    mz = np.concatenate([q[0] for q in quantities])
+    cv = np.concatenate([q[1] for q in quantities])
+    ion_count = np.concatenate([q[2] for q in quantities])
+
+    cv_order = np.argsort(cv, kind='stable')
+    cv_group = np.empty(len(cv), dtype=np.int64)
+    cv_group[cv_order] = np.cumsum(_group_starts(cv[cv_order], cv_tolerance)) - 1
+
+    order = np.lexsort((mz, cv_group))
+    sorted_mz = mz[order]
+    feature_starts = _group_starts(sorted_mz, ppm_tolerance * 1e-6 * sorted_mz[:-1])
+    feature_starts[1:] |= np.diff(cv_group[order]) != 0
+    sorted_feature = np.cumsum(feature_starts) - 1
+    feature = np.empty(len(mz), dtype=np.int64)
+    feature[order] = sorted_feature
+    n_features = int(feature_starts.sum())
+
+    weight = np.nan_to_num(ion_count)
+    summed = np.bincount(feature, weight, minlength=n_features)
+    counts = np.bincount(feature, minlength=n_features)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        consensus_mz = np.bincount(feature, mz * weight, minlength=n_features) / summed
+        plain_mz = np.bincount(feature, mz, minlength=n_features) / counts
+        consensus_cv = np.bincount(feature, cv, minlength=n_features) / counts
+    consensus_mz = np.where(summed > 0, consensus_mz, plain_mz)   # features of zero intensity keep their plain mean m/z
+    starts = np.flatnonzero(feature_starts)
+    ends = np.append(starts[1:], len(mz))[:len(starts)] - 1
+
+    labels = [f"{feature_mz:.4f}_{feature_cv}" for feature_mz, feature_cv in zip(consensus_mz.tolist(), consensus_cv.tolist())]
+    if len(set(labels)) < len(labels):
+        # features closer than the label precision, numbered to keep the labels unique
+        seen = {}
+        for i, label in enumerate(labels):
+            seen[label] = seen.get(label, 0) + 1
+            if seen[label] > 1:
+                labels[i] = f"{label}_{seen[label]}"
+
+    # per sample and feature the row of the highest Ion_count
+    best = np.lexsort((-ion_count, feature, sample_index))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = (np.diff(sample_index[best]) != 0) | (np.diff(feature[best]) != 0)
+    keep = best[first]
+    split = np.searchsorted(sample_index[keep], np.arange(1, len(samples)))
+    matrix = QuantMatrix(labels, list(samples), np.split(feature[keep].astype(np.int32), split), np.split(ion_count[keep], split))
+
+    features = pd.DataFrame({'PrecursorMZ': consensus_mz, 'Compensation Voltage': consensus_cv,
+                             'mz_min': sorted_mz[starts], 'mz_max': sorted_mz[ends],
+                             'n_samples': np.bincount(feature[keep][~np.isnan(ion_count[keep])], minlength=n_features)},
+                            index=pd.Index(labels, name='label'))
+    mapping = pd.DataFrame({'sample': pd.Categorical.from_codes(sample_index, categories=list(samples)),
+                            'PrecursorMZ': mz, 'Compensation Voltage': cv, 'Ion_count': ion_count,
+                            'feature': pd.Categorical.from_codes(feature, categories=labels)})
+    best_identifications = None
+    if identifications is not None:
+        macc_score = np.concatenate([ids['Macc_score'] for ids in identifications]).astype(np.float64)
+        best = _best_rows(feature, macc_score, n_features)
+        best_identifications = pd.DataFrame({column: np.concatenate([ids[column] for ids in identifications])[best]
+                                             for column in IDENTIFICATION_COLUMNS}, index=features.index)
+        best_identifications['identified_in'] = np.asarray(samples, dtype=object)[sample_index[best]]
+    return FeatureAlignment(features, mapping, matrix, best_identifications)
 
 
 class Meta_df_Merge:
-    
+
+    # columns used by reformat_df, the only ones read from the result files
+    required_columns = ['PrecursorMZ', 'Compensation Voltage', 'Ion_count']
+    # when a result is present in several formats (e.g. csv with an Excel export) the first one is used
+    result_extensions = ('.parquet', '.csv', '.xlsx')
+
     def __init__(self, folder_path):
         self.folder_path = folder_path
 
     def reformat_df(self, df):
-        
+
         '''Reformat the DataFrame with CV labeled and precursor rounded'''
         df['precursor'] = df['PrecursorMZ'].round(2)
         df['label'] = df['precursor'].astype(str) + '_' + df['Compensation Voltage'].astype(str)
         selected_columns = df[['label', 'Ion_count']]
         selected_columns = selected_columns.sort_values(by='Ion_count', ascending=False).drop_duplicates(subset='label', keep='first')
         selected_columns = selected_columns.set_index('label')
-        
+
         return selected_columns
 
-    def merge_dfs(self):
-        '''Merge DataFrames from all Excel files in the specified directory'''
-        dfs = []
-        
-        for filename in os.listdir(self.folder_path):
-            if filename.endswith('.xlsx'):
-                path = os.path.join(self.folder_path, filename)
-                df = pd.read_excel(path)
-                df_reformatted = self.reformat_df(df)
-                file_label = filename.replace('.xlsx', '')
-                df_reformatted.columns = [f"{file_label}" for col in df_reformatted.columns]
-                dfs.append(df_reformatted)
-
-        final_df = pd.concat(dfs, axis=1)
-        
-        return final_df
+    def result_files(self) -> dict:
+        '''{file label: path} of the identification results (.parquet, .csv or .xlsx) in the directory,
+        tables written by save_final_df (merged tables, feature mappings, compound tables) are left out'''
+        files = {}
+        outputs = written_outputs(self.folder_path)
+        for filename in sorted(os.listdir(self.folder_path)):
+            file_label, extension = os.path.splitext(filename)
+            extension = extension.lower()
+            if extension not in self.result_extensions or filename in outputs:
+                continue
+            if file_label in files and self.result_extensions.index(extension) >= \
+                    self.result_extensions.index(os.path.splitext(files[file_label])[1].lower()):
+                continue
+            files[file_label] = os.path.join(self.folder_path, filename)
+        return files
+
+    def read_results(self, progress_callback=None, cancel=None, n_workers=1, reader=read_quantities) -> tuple:
+        '''(samples, reader results) of the result files (.parquet, .csv or .xlsx) in the directory (see result_files),
+        files without the identification result columns are skipped.
+        Files are read once each by n_workers processes, only the columns needed with fixed dtypes, and reduced to arrays.
+        progress_callback receives ProgressReporter dicts per file read, cancel stops the reading with RunCancelled'''
+        result_files = self.result_files()
+        progress = ProgressReporter(progress_callback, len(result_files), label=self.folder_path, unit='files') \
+            if progress_callback is not None else None
+
+        samples, results = [], []
+        for file_label, file_result in zip(result_files, iter_quantities(list(result_files.values()), n_workers, reader)):
+            check_cancel(cancel)
+            if file_result is not None:
+                samples.append(file_label)
+                results.append(file_result)
+            if progress is not None:
+                progress.update()
+        if progress is not None:
+            progress.finish()
+        if not samples:
+            raise ValueError(f"No identification results in {self.folder_path}")
+        return samples, results
+
+    def merge_quantities(self, progress_callback=None, cancel=None, n_workers=1) -> QuantMatrix:
+        '''Merge the result files in the directory (see read_results) into a QuantMatrix. Labels
+        (precursor rounded to 2 decimals _ compensation voltage) are integer coded, their strings built once per label,
+        and ordered by first appearance, within a file by decreasing Ion_count'''
+        return build_matrix(*self.read_results(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers))
+
+    def align_features(self, ppm_tolerance, cv_tolerance=0.0, identifications=False, progress_callback=None, cancel=None,
+                       n_workers=1) -> FeatureAlignment:
+        '''Align the features of the result files in the directory by m/z tolerance (ppm) and compensation voltage
+        instead of rounded labels, see align_features. With identifications the best identification of every
+        feature is kept as well, for FeatureAlignment.compound_table'''
+        if identifications:
+            samples, results = self.read_results(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers,
+                                                 reader=read_identifications)
+            return align_features(samples, [r[0] for r in results], ppm_tolerance, cv_tolerance,
+                                  identifications=[r[1] for r in results])
+        samples, quantities = self.read_results(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers,
+                                                reader=partial(read_quantities, round_precursor=False))
+        return align_features(samples, quantities, ppm_tolerance, cv_tolerance)
+
+    def compound_table(self, ppm_tolerance=10.0, cv_tolerance=0.0, progress_callback=None, cancel=None, n_workers=1) -> pd.DataFrame:
+        '''compound level quantification of the result files in the directory, see FeatureAlignment.compound_table'''
+        return self.align_features(ppm_tolerance, cv_tolerance, identifications=True, progress_callback=progress_callback,
+                                   cancel=cancel, n_workers=n_workers).compound_table()
+
+    def merge_dfs(self, progress_callback=None, cancel=None, n_workers=1):
+        '''Merge DataFrames from all result files (.parquet, .csv or .xlsx) in the specified directory into one
+        labels x samples table of ion counts, see merge_quantities'''
+        return self.merge_quantities(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers).to_wide()
 
     def save_final_df(self, final_df, output_folder=None, output_filename='merged_output.csv'):
-        
-        '''Save the final merged DataFrame to a specified output folder and filename'''
-        
+
+        '''Save the final merged DataFrame to a specified output folder and filename,
+        as parquet for a .parquet filename and csv otherwise. Long tables (QuantMatrix.to_long) are saved without row numbers.
+        The file name is recorded in the OUTPUTS_FILENAME of the folder, so that a later merge of the folder skips it'''
+
         if output_folder is None:
             output_folder = self.folder_path  # Use the initial folder path if no output folder is specified
         output_path = os.path.normpath(os.path.join(output_folder, output_filename))
-        
-        final_df.to_csv(output_path)
-        
-        print(f"Saved merged DataFrame to {output_path}")
-
-
-
 
+        write_index = not isinstance(final_df.index, pd.RangeIndex)
+        if output_path.lower().endswith('.parquet'):
+            final_df.to_parquet(output_path, index=write_index)
+        else:
+            final_df.to_csv(output_path, index=write_index)
+        outputs = written_outputs(os.path.dirname(output_path))
+        if os.path.basename(output_path) not in outputs:
+            outputs.add(os.path.basename(output_path))
+            _atomic_write(os.path.join(os.path.dirname(output_path), OUTPUTS_FILENAME),
+                          json.dumps(sorted(outputs), indent=1).encode('utf-8'))
 
+        print(f"Saved merged DataFrame to {output_path}")
@@ -0,0 +1,190 @@
+import os
+import re
+import heapq
+import logging
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from IdentificationMeta import normalize_to_100
+
+
+PLOT_FORMATS = ('svg', 'png', 'pdf')
+
+# everything needed to draw one identification, plain data so that jobs can be sent to the plotting processes
+PlotJob = namedtuple('PlotJob', ['source', 'compound', 'cosine', 'scan_index',
+                                 'library_mz', 'library_intensity', 'query_mz', 'query_intensity'])
+
+
+def sanitize_filename(filename):
+    # Replace any invalid characters with an underscore
+    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+
+
+def make_plot_job(compound_info, cos, scan_index, source='') -> PlotJob:
+    """plot data of a hit: the library spectrum of the compound and the matched query peaks of cos (cosine, matched peaks)"""
+    return PlotJob(source, compound_info.get('name', 'Unknown Compound'), float(cos[0]), scan_index,
+                   [float(mz) for mz in compound_info['mz']], [float(inten) for inten in compound_info['intensity']],
+                   [float(x[0]) for x in cos[1]], [float(x[1]) for x in cos[1]])
+
+
+def plot_file_name(job, output_format) -> str:
+    return f"{sanitize_filename(job.compound)}_{job.scan_index}.{output_format}"
+
+
+def draw_plot(job, figure):
+    """draw the library spectrum (up) against the query spectrum (down) of a PlotJob into a matplotlib Figure"""
+    ax = figure.add_subplot()
+    # Plot library spectrum
+    ax.vlines(job.library_mz, [0], normalize_to_100(job.library_intensity), colors="red", label='Library Spectrum')
+    # Plot query spectrum (inverted)
+    ax.vlines(job.query_mz, [0], [-item for item in normalize_to_100(job.query_intensity)], colors="blue", label='Query Spectrum')
+    # Plot horizontal line at y=0
+    ax.axhline(y=0, color='gray', alpha=0.8, linewidth=1)
+    ax.legend()
+    ax.set_title(f"{job.compound} | Cosine Score: {job.cosine:.2f} | Scan: {job.scan_index}")
+
+
+def render_plot(job, file_path, dpi=300):
+    """render one PlotJob to an image file, the format follows the file extension"""
+    from matplotlib.figure import Figure
+    figure = Figure()
+    draw_plot(job, figure)
+    figure.savefig(file_path, dpi=dpi, bbox_inches='tight')
+
+
+def render_pdf(jobs, file_path):
+    """render PlotJobs as the pages of one pdf, written under a temporary name and moved into place"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+    tmp_path = file_path + '.tmp'
+    with PdfPages(tmp_path) as pdf:
+        for job in jobs:
+            figure = Figure()
+            draw_plot(job, figure)
+            pdf.savefig(figure, bbox_inches='tight')
+    os.replace(tmp_path, file_path)
+    return len(jobs)
+
+
+def _render_plots(jobs, fig_path, output_format):
+    for job in jobs:
+        render_plot(job, os.path.join(fig_path, plot_file_name(job, output_format)))
+    return len(jobs)
+
+
+class PlotJobList(list):
+    """collects PlotJobs in a process without a PlotQueue, e.g. an identification worker, to be submitted later"""
+    submit = list.append
+
+
+def _init_plot_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+    matplotlib.rcParams['font.family'] = 'Arial'
+
+
+class PlotQueue:
+    """
+    Queue of identification plots rendered by a pool of processes with the non-interactive Agg backend,
+    so the scan loop only hands over the plot data.
+    min_score keeps hits with a cosine score of at least min_score, top_n keeps the top_n best scoring hits per
+    compound (and input file), these are only known once the input file is done.
+    output_format 'svg' or 'png' writes one file per hit like generate_plot, 'pdf' one multi-page pdf per input file
+    (<input file>_plots.pdf, pages in submission order).
+    finish_source(source) renders the top_n hits and the pdf of an input file when its identification is done, so the
+    plot data of a batch is not held until the end, close renders whatever is left.
+    """
+
+    def __init__(self, fig_path, output_format='svg', top_n=None, min_score=None, n_workers=1, batch_size=32):
+        if output_format not in PLOT_FORMATS:
+            raise ValueError(f"Unsupported plot format: {output_format}")
+        self.fig_path = fig_path
+        self.output_format = output_format
+        self.top_n = top_n
+        self.min_score = min_score
+        self.batch_size = batch_size
+        self.plots_written = 0
+        self._executor = ProcessPoolExecutor(max_workers=max(1, n_workers), initializer=_init_plot_worker)
+        self._futures = []
+        self._batch = []
+        self._count = 0
+        self._top = defaultdict(dict)       # source -> {compound: heap of (score, -count, job)}
+        self._pdf_jobs = defaultdict(list)  # source -> [(count, job)]
+
+    def params(self) -> dict:
+        """settings that decide which plots are written, recorded with the parameters of checkpointed runs"""
+        return {'format': self.output_format, 'top_n': self.top_n, 'min_score': self.min_score}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, job):
+        """hand over the PlotJob of a hit, it is filtered and queued for rendering"""
+        if self.min_score is not None and job.cosine < self.min_score:
+            return
+        self._count += 1
+        if self.top_n is not None:
+            heap = self._top[job.source].setdefault(job.compound, [])
+            item = (job.cosine, -self._count, job)   # equal scores keep the earlier hit
+            if len(heap) < self.top_n:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+            return
+        self._queue(self._count, job)
+
+    def _queue(self, count, job):
+        if self.output_format == 'pdf':
+            self._pdf_jobs[job.source].append((count, job))
+            return
+        self._batch.append(job)
+        if len(self._batch) >= self.batch_size:
+            self._submit_batch()
+
+    def _submit_batch(self):
+        if self._batch:
+            self._futures.append(self._executor.submit(_render_plots, self._batch, self.fig_path, self.output_format))
+            self._batch = []
+
+    def finish_source(self, source):
+        """queue the kept top_n hits and the pdf of an input file for rendering, no more plots of it are submitted"""
+        for heap in self._top.pop(source, {}).values():
+            for score, negative_count, job in heap:
+                self._queue(-negative_count, job)
+        self._submit_batch()
+        jobs = self._pdf_jobs.pop(source, None)
+        if jobs:
+            pages = [job for _, job in sorted(jobs, key=lambda item: item[0])]
+            file_path = os.path.join(self.fig_path, f"{sanitize_filename(source or 'identified')}_plots.pdf")
+            self._futures.append(self._executor.submit(render_pdf, pages, file_path))
+        self._collect(wait=False)
+
+    def _collect(self, wait):
+        """count the plots of finished renderings, with wait of all of them"""
+        pending = []
+        for future in self._futures:
+            if not wait and not future.done():
+                pending.append(future)
+                continue
+            try:
+                self.plots_written += future.result()
+            except Exception as e:
+                logging.error(f"Plot rendering failed: {e}")
+        self._futures = pending
+
+    def close(self):
+        """render the remaining plots and wait for the plotting processes, returns the number of plots written"""
+        if self._executor is None:
+            return self.plots_written
+        try:
+            for source in set(self._top) | set(self._pdf_jobs):
+                self.finish_source(source)
+            self._submit_batch()
+            self._collect(wait=True)
+        finally:
+            self._executor.shutdown()
+            self._executor = None
+        return self.plots_written
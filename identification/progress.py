@@ -0,0 +1,72 @@
+import time
+
+
+class RunCancelled(Exception):
+    """raised inside a run when its cancel hook asks to stop"""
+
+
+def check_cancel(cancel):
+    """raise RunCancelled when the cancel hook (a callable returning True to stop) is set"""
+    if cancel is not None and cancel():
+        raise RunCancelled('run cancelled')
+
+
+class ProgressReporter:
+    """
+    Counts the work done by a long running job and reports it to callback as a dict:
+    label, done, total (None when unknown), percent, rate (units per second), eta (seconds) and unit,
+    plus the items of extra. Reports are throttled to one per min_interval seconds, finish() always reports.
+    """
+
+    def __init__(self, callback, total=None, label='', unit='scans', min_interval=0.5, extra=None):
+        self.callback = callback
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.min_interval = min_interval
+        self.extra = extra or {}
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self._last_report = None
+
+    def __call__(self, n=1):
+        self.update(n)
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if self._last_report is None or now - self._last_report >= self.min_interval:
+            self._report(now)
+
+    def finish(self):
+        self._report(time.perf_counter())
+
+    def snapshot(self, now=None) -> dict:
+        elapsed = (now if now is not None else time.perf_counter()) - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        percent = eta = None
+        if self.total:
+            percent = min(100.0, 100.0 * self.done / self.total)
+            eta = (self.total - self.done) / rate if rate > 0 else None
+        info = {'label': self.label, 'done': self.done, 'total': self.total, 'percent': percent,
+                'rate': rate, 'eta': eta, 'elapsed': elapsed, 'unit': self.unit}
+        info.update(self.extra)
+        return info
+
+    def _report(self, now):
+        self._last_report = now
+        if self.callback is not None:
+            self.callback(self.snapshot(now))
+
+
+def format_progress(info) -> str:
+    """one line summary of a ProgressReporter dict, e.g. for a log or status label"""
+    text = f"{info['label']}: {info['done']}"
+    if info['total']:
+        text += f"/{info['total']} {info['unit']} ({info['percent']:.1f}%)"
+    else:
+        text += f" {info['unit']}"
+    text += f", {info['rate']:.1f} {info['unit']}/s"
+    if info['eta'] is not None:
+        text += f", ETA {int(info['eta'] // 60)}:{int(info['eta'] % 60):02d}"
+    return text
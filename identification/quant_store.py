@@ -0,0 +1,130 @@
+import os
+import io
+import json
+import hashlib
+import numpy as np
+
+from meta_quan_merge import Meta_df_Merge, build_matrix, iter_quantities
+from run_manifest import file_content_hash, _atomic_write
+from progress import ProgressReporter, check_cancel
+
+
+STORE_FILENAME = 'dimeta_quant.json'
+STORE_FOLDER = '.dimeta_quant'
+STORE_VERSION = 1   # bump when read_quantities changes, stored quantities of another version are read again
+
+
+class QuantStore(Meta_df_Merge):
+    """
+    Incremental quantification merge of a results folder.
+    The quantities of every merged result file (see read_quantities) are kept in store_folder (the results folder by
+    default) under .dimeta_quant/, with a record of the file in dimeta_quant.json: size, modification time and
+    content hash. A merge only reads result files that are new or whose content changed, files that are gone are
+    dropped, and the matrix is assembled from the stored quantities, so that merge_dfs/save_final_df give the same
+    merged_output.csv as a full Meta_df_Merge.
+    A changed size or modification time triggers a hash of the file, the file is only read again when its hash changed.
+    """
+
+    def __init__(self, folder_path, store_folder=None):
+        super().__init__(folder_path)
+        self.store_folder = store_folder if store_folder is not None else folder_path
+        self.path = os.path.join(self.store_folder, STORE_FILENAME)
+        self.data = {'version': STORE_VERSION, 'files': {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                if data.get('version') == STORE_VERSION:
+                    self.data = data
+            except (OSError, ValueError):
+                pass   # unreadable store, start over
+        self.last_update = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+
+    def save(self):
+        _atomic_write(self.path, json.dumps(self.data, indent=1).encode('utf-8'))
+
+    def quantities_path(self, filename) -> str:
+        label = hashlib.sha256(filename.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.store_folder, STORE_FOLDER, label + '.npz')
+
+    def _store_quantities(self, filename, quantities):
+        os.makedirs(os.path.join(self.store_folder, STORE_FOLDER), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, precursor=quantities[0], cv=quantities[1], ion_count=quantities[2])
+        _atomic_write(self.quantities_path(filename), buffer.getvalue())
+
+    def _load_quantities(self, filename) -> tuple:
+        with np.load(self.quantities_path(filename)) as stored:
+            return stored['precursor'], stored['cv'], stored['ion_count']
+
+    def _remove(self, filename):
+        del self.data['files'][filename]
+        if os.path.exists(self.quantities_path(filename)):
+            os.remove(self.quantities_path(filename))
+
+    def update(self, progress_callback=None, cancel=None, n_workers=1, result_files=None) -> dict:
+        """
+        Bring the store up to date with the result files ({file label: path}, by default those of the results folder),
+        reading new and changed files with n_workers processes.
+        Returns the number of files added, changed, removed and unchanged (also kept as last_update).
+        """
+        if result_files is None:
+            result_files = self.result_files()
+        result_files = {os.path.basename(path): path for path in result_files.values()}
+        files = self.data['files']
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        for filename in [filename for filename in files if filename not in result_files]:
+            self._remove(filename)
+            counts['removed'] += 1
+
+        to_read = []
+        for filename, path in result_files.items():
+            stat = os.stat(path)
+            entry = files.get(filename)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                counts['unchanged'] += 1
+                continue
+            content_hash = file_content_hash(path)
+            if entry is not None and entry['content_hash'] == content_hash and \
+                    (not entry['result'] or os.path.exists(self.quantities_path(filename))):
+                entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns   # touched, not changed
+                counts['unchanged'] += 1
+                continue
+            counts['changed' if entry is not None else 'added'] += 1
+            to_read.append((filename, path, stat, content_hash))
+
+        progress = ProgressReporter(progress_callback, len(to_read), label=self.folder_path, unit='files') \
+            if progress_callback is not None else None
+        try:
+            for (filename, path, stat, content_hash), quantities in zip(to_read, iter_quantities([item[1] for item in to_read], n_workers)):
+                check_cancel(cancel)
+                # result False: not an identification result (e.g. a merged output), remembered so it is not read again
+                if quantities is not None:
+                    self._store_quantities(filename, quantities)
+                elif os.path.exists(self.quantities_path(filename)):
+                    os.remove(self.quantities_path(filename))
+                files[filename] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'content_hash': content_hash,
+                                   'result': quantities is not None}
+                if progress is not None:
+                    progress.update()
+        finally:
+            # files read before a cancel or an error are kept
+            self.save()
+        if progress is not None:
+            progress.finish()
+        self.last_update = counts
+        return counts
+
+    def merge_quantities(self, progress_callback=None, cancel=None, n_workers=1):
+        """update the store and assemble the QuantMatrix of all result files from it, see Meta_df_Merge.merge_quantities"""
+        result_files = self.result_files()
+        self.update(progress_callback=progress_callback, cancel=cancel, n_workers=n_workers, result_files=result_files)
+        samples, quantities = [], []
+        for file_label, path in result_files.items():
+            filename = os.path.basename(path)
+            if self.data['files'][filename]['result']:
+                samples.append(file_label)
+                quantities.append(self._load_quantities(filename))
+        if not samples:
+            raise ValueError(f"No identification results in {self.folder_path}")
+        return build_matrix(samples, quantities)
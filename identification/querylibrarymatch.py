@@ -4,29 +4,43 @@
 import sys
 import os
 import uuid
-import matplotlib.pyplot as plt
 import os
 import glob
 import numpy as np
 import heapq
-import re
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path
-from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
-import pandas as pd 
+from result_writer import ResultWriter, result_file_path
+from run_manifest import RunManifest
+from progress import ProgressReporter, RunCancelled, check_cancel
+from plot_queue import PlotQueue, PlotJobList, make_plot_job, plot_file_name, render_plot, sanitize_filename
+from IdentificationMeta import QueryTargetedSpectrum, LibraryIndex, CandidateCache, MatchedPeaks, score_candidates, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
 
 #result_dict = defaultdict(list)
 
+RESULT_COLUMNS = ['PrecursorMZ', 'Compensation Voltage', 'Cosine_score', 'Ion_count', 'Scan',
+                  'Compound', 'CompoundMZ', 'Adduct', 'Formula', 'Macc_score', 'Matched_peaks', 'Scans']
+
+AGGREGATION_MODES = ('sum', 'mean')
+
     
 def get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance):
-    query_spectrum = analyzer.get_query_spectrum(scan_index)
+    query_spectrum = analyzer.get_query_peaks(scan_index)
     realtime_library = analyzer.get_realtime_lib(scan_index, library, PrecursorIonMassTolerance)
-    target_spectrum = analyzer.get_target_spectrum(scan_index, library, PrecursorIonMassTolerance)
+    target_spectrum = analyzer.get_target_peaks(scan_index, library, PrecursorIonMassTolerance)
     return query_spectrum, realtime_library, target_spectrum
 
 
 def match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks):
     matched_peaks = match_spectrum(query_spectrum, target_spectrum, ppm_tolerance)
+    if isinstance(matched_peaks, MatchedPeaks):
+        # all candidates of the scan are scored in one vectorized pass
+        scores = score_candidates(matched_peaks, minmatchedpeaks)
+        return [(scores.cosine[i], scores.candidate_matches(i)) for i in range(len(scores))]
+
     cosine_scores = []
     for matched_spectrum in group_tuples_by_same_value(matched_peaks, -1):
         filtered_matches = filter_tuples(matched_spectrum)
@@ -35,44 +49,55 @@ def match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_t
             cosine_scores.append((cosine_score, filtered_matches))
     return cosine_scores
 
-def sanitize_filename(filename):
-    # Replace any invalid characters with an underscore
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
-    
 def generate_plot(compound_info, cos, scan_index, fig_path):
-# Normalize intensities to 100
-    real_query_spectrum = cos[1]
-    library_mz = compound_info['mz']
-    library_intensity = normalize_to_100(compound_info['intensity'])
-    query_mz = [x[0] for x in real_query_spectrum]
-    query_intensity = normalize_to_100([x[1] for x in real_query_spectrum])
-    plt.rcParams['font.family'] = 'Arial'
-    # Plot library spectrum
-    plt.vlines(library_mz, [0], library_intensity, colors="red", label='Library Spectrum')
-    # Plot query spectrum (inverted)
-    plt.vlines(query_mz, [0], [-item for item in query_intensity], colors="blue", label='Query Spectrum')  
-    # Plot horizontal line at y=0
-    plt.axhline(y=0, color='gray', alpha = 0.8, linewidth=1)
-    plt.legend()
-    plt.title(f"{compound_info.get('name', 'Unknown Compound')} | Cosine Score: {cos[0]:.2f} | Scan: {scan_index}") 
-    # Sanitize the compound name for the filename
-    compound_name = compound_info.get('name', 'Unknown Compound')
-    sanitized_name = sanitize_filename(compound_name)
-    # Create the filename using the sanitized compound name
-    filename = f"{sanitized_name}_{scan_index}.svg"
-    # Save the figure
-    plt.savefig(os.path.join(fig_path, filename), dpi=300, bbox_inches='tight')
-    # plt.show()
-    plt.close()
+    """render the plot of one hit synchronously as <compound>_<scan>.svg, see PlotQueue for off-loop rendering"""
+    import matplotlib
+    matplotlib.rcParams['font.family'] = 'Arial'
+    job = make_plot_job(compound_info, cos, scan_index)
+    render_plot(job, os.path.join(fig_path, plot_file_name(job, 'svg')))
+
+
+def get_aggregated_spectra(analyzer, scans, library, PrecursorIonMassTolerance, aggregation_ppm, aggregate):
+    """consensus query spectrum of replicate scans of one window, candidates are taken from the first scan"""
+    query_spectrum = analyzer.get_consensus_peaks(scans, aggregation_ppm, mode=aggregate)
+    realtime_library = analyzer.get_realtime_lib(int(scans[0]), library, PrecursorIonMassTolerance)
+    target_spectrum = analyzer.get_target_peaks(int(scans[0]), library, PrecursorIonMassTolerance)
+    return query_spectrum, realtime_library, target_spectrum
 
 
 def main_processing_function(lowerscan,higherscan, analyzer, library, PrecursorIonMassTolerance, 
-                             cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots=False):
-    result_dict = { 'PrecursorMZ': [],'Compensation Voltage': [], 'Cosine_score': [], 'Ion_count': [], 'Scan': [], 
-                   'Compound': [], 'CompoundMZ': [], 'Adduct': [], 'Formula': [], 'Macc_score': [], 'Matched_peaks': [] }
+                             cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots=False,
+                             aggregate=None, aggregation_ppm=None, scan_groups=None, writer=None, plot_queue=None,
+                             progress=None, cancel=None):
+    '''
+    Identify every scan in range(lowerscan, higherscan).
+    With aggregate ('sum' or 'mean') the MS2 scans are grouped by (isolation target, compensation voltage) first,
+    the peaks of each group are merged within aggregation_ppm (default ppm_tolerance) and every group is identified once;
+    Scan is then the first scan of the group and Scans lists all scans that contributed.
+    scan_groups overrides the grouping with precomputed lists of scan indices.
+    With a ResultWriter the rows of every scan are handed to the writer as they are produced instead of being
+    collected, the returned result_dict then only holds rows not yet handed over (none).
+    With generate_plots and a plot_queue (PlotQueue or PlotJobList) the plot data is queued instead of rendered in the loop.
+    progress is called with the number of scans processed after every scan (group), cancel is checked before every
+    scan (group) and stops the run with RunCancelled when it returns True.
+    '''
+    result_dict = {column: [] for column in RESULT_COLUMNS}
     #result_dict = {}
-    for scan_index in range(lowerscan,higherscan):
-        query_spectrum, realtime_library, target_spectrum = get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance)
+    if aggregate:
+        if aggregate not in AGGREGATION_MODES:
+            raise ValueError(f"Unsupported aggregation mode: {aggregate}")
+        if scan_groups is None:
+            scan_groups = [scans for _, _, scans in analyzer.group_scans(lowerscan, higherscan)]
+        units = [(int(scans[0]), scans) for scans in scan_groups]
+    else:
+        units = [(scan_index, (scan_index,)) for scan_index in range(lowerscan, higherscan)]
+    for scan_index, scans in units:
+        check_cancel(cancel)
+        if aggregate:
+            query_spectrum, realtime_library, target_spectrum = get_aggregated_spectra(
+                analyzer, scans, library, PrecursorIonMassTolerance, aggregation_ppm or ppm_tolerance, aggregate)
+        else:
+            query_spectrum, realtime_library, target_spectrum = get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance)
         
         cosine_scores = match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks)
         
@@ -85,7 +110,7 @@ def main_processing_function(lowerscan,higherscan, analyzer, library, PrecursorI
             # Process each selected score
             for cos in filtered_scores:
                 number = int(cos[1][0][-1])
-                ioncount = round(sum([it[1] for it in cos[1]]), 3)
+                ioncount = round(sum(cos[1].query_intensity), 3)
                 
                 # Retrieve compound information
                 try:
@@ -117,20 +142,391 @@ def main_processing_function(lowerscan,higherscan, analyzer, library, PrecursorI
                 result_dict['Macc_score'].append(macc_score(len(cos[1]), cos[0]))
                 result_dict['Matched_peaks'].append(len(cos[1])) 
                 result_dict['Compensation Voltage'].append(str(analyzer.get_compensation_voltage(scan_index))) 
+                result_dict['Scans'].append(';'.join(str(scan) for scan in scans))
                 # **Generate plot for each match if enabled**
                 if generate_plots:
-                    generate_plot(compound_info, cos, scan_index, fig_path)
+                    if plot_queue is not None:
+                        plot_queue.submit(make_plot_job(compound_info, cos, scan_index, source=_file_label(analyzer.filepath)))
+                    else:
+                        generate_plot(compound_info, cos, scan_index, fig_path)
+        if writer is not None and result_dict['Scan']:
+            writer.write_rows(result_dict)
+            result_dict = {column: [] for column in RESULT_COLUMNS}
+        if progress is not None:
+            progress(len(scans))
     return result_dict
 
     
-def save_results(result_dict, fig_path, mzml_file_path):
+def _file_label(file_path):
+    return os.path.basename(file_path).split('.')[0]
+
+
+def save_results(result_dict, fig_path, mzml_file_path, output_format='xlsx'):
     
-    df = pd.DataFrame(result_dict)
-    df.to_excel(os.path.join(fig_path, f"{mzml_file_path.split('/')[-1].split('.')[0]}.xlsx"), index=False)
+    with ResultWriter(result_file_path(fig_path, mzml_file_path, output_format), output_format, columns=RESULT_COLUMNS) as writer:
+        writer.write_rows(result_dict)
+
+
+def merge_result_dicts(result_dicts):
+    """concatenate result dicts column by column, in the given order"""
+    merged = {column: [] for column in RESULT_COLUMNS}
+    for result_dict in result_dicts:
+        for column in RESULT_COLUMNS:
+            merged[column].extend(result_dict[column])
+    return merged
+
+
+def split_scan_range(lowerscan, higherscan, chunk_size):
+    """split range(lowerscan, higherscan) into consecutive (lower, higher) chunks"""
+    return [(start, min(start + chunk_size, higherscan)) for start in range(lowerscan, higherscan, chunk_size)]
+
+
+# per-process state of the identification workers, the library is handed over once by the pool initializer
+# (inherited copy-on-write where processes are forked) and every worker keeps its own indexed readers
+_worker_state = {}
+
+def _init_identification_worker(library, candidate_cache_size, preprocessing=None):
+    _worker_state['library'] = library
+    _worker_state['preprocessing'] = preprocessing
+    _worker_state['analyzers'] = {}
+    _worker_state['candidate_cache'] = CandidateCache(candidate_cache_size)
+
+def _identify_scan_chunk(InputFilePath, intensity_threshold, lowerscan, higherscan, PrecursorIonMassTolerance,
+                         cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots,
+                         aggregate=None, aggregation_ppm=None, scan_groups=None):
+    """(result_dict, plot jobs) of a chunk, plots are rendered by the PlotQueue of the parent process"""
+    analyzers = _worker_state['analyzers']
+    if InputFilePath not in analyzers:
+        analyzers[InputFilePath] = QueryTargetedSpectrum(InputFilePath, intensity_threshold,
+                                                         candidate_cache=_worker_state['candidate_cache'],
+                                                         preprocessing=_worker_state['preprocessing'])
+    plot_jobs = PlotJobList()
+    result_dict = main_processing_function(lowerscan, higherscan, analyzers[InputFilePath], _worker_state['library'],
+                                           PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance, minmatchedpeaks,
+                                           fig_path, generate_plots=generate_plots, aggregate=aggregate,
+                                           aggregation_ppm=aggregation_ppm, scan_groups=scan_groups, plot_queue=plot_jobs)
+    return result_dict, plot_jobs
+
+
+def _collect_chunk(future, plot_queue) -> dict:
+    """result_dict of a finished chunk, its plot jobs are handed to the plot queue"""
+    result_dict, plot_jobs = future.result()
+    if plot_queue is not None:
+        for job in plot_jobs:
+            plot_queue.submit(job)
+    return result_dict
+
+
+def run_identification(InputFilePaths, library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance, minmatchedpeaks,
+                       fig_path, intensity_threshold=3000, lowerscan=0, higherscan=None, generate_plots=False,
+                       n_workers=1, chunk_size=500, save=True, candidate_cache_size=256, aggregate=None, aggregation_ppm=None,
+                       output_format='csv', excel_export=False, batch_size=5000, checkpoint=False,
+                       plot_format='svg', plot_top_n=None, plot_min_score=None, plot_workers=1,
+                       preprocessing=None, progress_callback=None, cancel=None):
+    """
+    Identify metabolites in every input file.
+    With save the rows are streamed in batches of batch_size into one result file per input file in fig_path
+    (output_format 'csv', 'parquet' or 'xlsx', excel_export adds a .xlsx copy) and {input file path: result file path}
+    is returned, without save {input file path: result_dict}.
+    With checkpoint the run is resumable, see run_checkpointed_identification.
+
+    With n_workers > 1 the scan range of every file is split into chunks of chunk_size scans which are
+    processed by a pool of n_workers processes, each worker opens its own indexed reader of the input file.
+    Chunk results are merged in scan order, so the output is the same as a serial run.
+    higherscan=None processes every scan up to the end of each file.
+    The candidates of up to candidate_cache_size isolation windows are kept (per worker) and shared between files.
+    aggregate ('sum' or 'mean') identifies merged replicate scans per window, see main_processing_function;
+    in parallel runs chunks then hold chunk_size scan groups.
+    With generate_plots the plots are rendered by a PlotQueue of plot_workers processes while identification goes on,
+    plot_format 'svg', 'png' or 'pdf' (one multi-page pdf per input file), plot_top_n and plot_min_score limit the
+    plots to the best hits per compound and to hits scoring at least plot_min_score.
+    preprocessing (a QueryPreprocessing) centroids and filters the query spectra before matching, by default they are
+    only filtered by intensity_threshold.
+    progress_callback receives ProgressReporter dicts per input file (label: file path, file_index, n_files),
+    cancel is a callable polled between scans (or chunks), when it returns True the run stops with RunCancelled;
+    rows already written and committed checkpoints are kept.
+    """
+    if not isinstance(library, LibraryIndex):
+        library = LibraryIndex(library)
+    plot_queue = None
+    if generate_plots:
+        plot_queue = PlotQueue(fig_path, plot_format, top_n=plot_top_n, min_score=plot_min_score, n_workers=plot_workers)
+    try:
+        return _run_identification(InputFilePaths, library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                                   minmatchedpeaks, fig_path, intensity_threshold, lowerscan, higherscan, generate_plots,
+                                   n_workers, chunk_size, save, candidate_cache_size, aggregate, aggregation_ppm,
+                                   output_format, excel_export, batch_size, checkpoint, plot_queue, preprocessing,
+                                   progress_callback, cancel)
+    finally:
+        if plot_queue is not None:
+            plot_queue.close()
+
+
+def _run_identification(InputFilePaths, library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                        minmatchedpeaks, fig_path, intensity_threshold, lowerscan, higherscan, generate_plots,
+                        n_workers, chunk_size, save, candidate_cache_size, aggregate, aggregation_ppm,
+                        output_format, excel_export, batch_size, checkpoint, plot_queue, preprocessing,
+                        progress_callback, cancel):
+    if checkpoint and save:
+        return run_checkpointed_identification(InputFilePaths, library, PrecursorIonMassTolerance, cosine_threshold,
+                                               ppm_tolerance, minmatchedpeaks, fig_path, intensity_threshold=intensity_threshold,
+                                               lowerscan=lowerscan, higherscan=higherscan, generate_plots=generate_plots,
+                                               n_workers=n_workers, chunk_size=chunk_size,
+                                               candidate_cache_size=candidate_cache_size, aggregate=aggregate,
+                                               aggregation_ppm=aggregation_ppm, output_format=output_format,
+                                               excel_export=excel_export, batch_size=batch_size, plot_queue=plot_queue,
+                                               preprocessing=preprocessing, progress_callback=progress_callback,
+                                               cancel=cancel)
+
+    scan_ranges = {}
+    for InputFilePath in InputFilePaths:
+        file_higherscan = higherscan
+        if file_higherscan is None:
+            file_higherscan = QueryTargetedSpectrum(InputFilePath, intensity_threshold).get_scans()
+        scan_ranges[InputFilePath] = (lowerscan, file_higherscan)
+
+    results = {}
+    if n_workers <= 1:
+        candidate_cache = CandidateCache(candidate_cache_size)
+        for file_index, InputFilePath in enumerate(InputFilePaths):
+            analyzer = QueryTargetedSpectrum(InputFilePath, intensity_threshold, candidate_cache=candidate_cache,
+                                             preprocessing=preprocessing)
+            scan_groups = None
+            total = scan_ranges[InputFilePath][1] - scan_ranges[InputFilePath][0]
+            if aggregate:
+                scan_groups = [scans for _, _, scans in analyzer.group_scans(*scan_ranges[InputFilePath])]
+                total = sum(len(scans) for scans in scan_groups)
+            progress = _file_progress(progress_callback, InputFilePath, total, file_index, len(InputFilePaths))
+            writer = _open_writer(save, fig_path, InputFilePath, output_format, excel_export, batch_size)
+            try:
+                results[InputFilePath] = main_processing_function(*scan_ranges[InputFilePath], analyzer, library,
+                                                                  PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                                                                  minmatchedpeaks, fig_path, generate_plots=generate_plots,
+                                                                  aggregate=aggregate, aggregation_ppm=aggregation_ppm,
+                                                                  scan_groups=scan_groups, writer=writer,
+                                                                  plot_queue=plot_queue, progress=progress, cancel=cancel)
+            finally:
+                if writer is not None:
+                    writer.close()   # rows identified before an error are kept
+            if progress is not None:
+                progress.finish()
+            if plot_queue is not None:
+                plot_queue.finish_source(_file_label(InputFilePath))
+            if writer is not None:
+                results[InputFilePath] = writer.file_path
+        return results
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_identification_worker, initargs=(library, candidate_cache_size, preprocessing)) as executor:
+        futures, chunk_scans = {}, {}
+        for InputFilePath in InputFilePaths:
+            chunks = _file_chunks(InputFilePath, intensity_threshold, scan_ranges[InputFilePath], chunk_size, aggregate)
+            chunk_scans[InputFilePath] = [_chunk_scans(chunk) for chunk in chunks]
+            futures[InputFilePath] = [executor.submit(_identify_scan_chunk, InputFilePath, intensity_threshold, lower, higher,
+                                                      PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                                                      minmatchedpeaks, fig_path, generate_plots,
+                                                      aggregate, aggregation_ppm, scan_groups)
+                                      for lower, higher, scan_groups in chunks]
+        try:
+            for file_index, InputFilePath in enumerate(InputFilePaths):
+                progress = _file_progress(progress_callback, InputFilePath, sum(chunk_scans[InputFilePath]),
+                                          file_index, len(InputFilePaths))
+                chunk_results = _iter_chunk_results(futures[InputFilePath], chunk_scans[InputFilePath], plot_queue,
+                                                    progress, cancel)
+                writer = _open_writer(save, fig_path, InputFilePath, output_format, excel_export, batch_size)
+                if writer is None:
+                    results[InputFilePath] = merge_result_dicts(chunk_results)
+                else:
+                    with writer:
+                        # chunks are written in scan order as they complete
+                        for result_dict in chunk_results:
+                            writer.write_rows(result_dict)
+                    results[InputFilePath] = writer.file_path
+                if progress is not None:
+                    progress.finish()
+                if plot_queue is not None:
+                    plot_queue.finish_source(_file_label(InputFilePath))
+        except BaseException:
+            for file_futures in futures.values():
+                for future in file_futures:
+                    future.cancel()
+            raise
+    return results
+
+
+def _iter_chunk_results(futures, chunk_scans, plot_queue, progress, cancel):
+    """result dicts of the chunk futures in order, checking cancel before waiting for each"""
+    for future, scans in zip(futures, chunk_scans):
+        check_cancel(cancel)
+        result_dict = _collect_chunk(future, plot_queue)
+        if progress is not None:
+            progress(scans)
+        yield result_dict
+
+
+def _chunk_scans(chunk) -> int:
+    """number of scans in a (lower, higher, scan_groups) work unit"""
+    lower, higher, scan_groups = chunk
+    if scan_groups is not None:
+        return sum(len(scans) for scans in scan_groups)
+    return higher - lower
+
+
+def _file_progress(progress_callback, InputFilePath, total, file_index, n_files):
+    if progress_callback is None:
+        return None
+    return ProgressReporter(progress_callback, total, label=InputFilePath, unit='scans',
+                            extra={'file_index': file_index, 'n_files': n_files})
+
+
+def _file_chunks(InputFilePath, intensity_threshold, scan_range, chunk_size, aggregate):
+    """(lower, higher, scan_groups) work units of a file, consecutive scan ranges or, with aggregate, chunks of scan groups"""
+    if aggregate:
+        # groups span the whole scan range, so they are formed here and handed out in chunks
+        groups = [scans for _, _, scans in QueryTargetedSpectrum(InputFilePath, intensity_threshold).group_scans(*scan_range)]
+        return [(None, None, groups[start:start + chunk_size]) for start in range(0, len(groups), chunk_size)]
+    return [(lower, higher, None) for lower, higher in split_scan_range(*scan_range, chunk_size)]
+
 
+def _library_fingerprint(library) -> str:
+    """hash of the precursor index and the peaks of a LibraryIndex, recorded with the parameters of checkpointed runs,
+    so that a library with changed fragment peaks invalidates finished files"""
+    digest = hashlib.sha256(np.ascontiguousarray(library.sorted_precursors).tobytes())
+    digest.update(np.ascontiguousarray(library.order, dtype=np.int64).tobytes())
+    spectra = library.library
+    if getattr(spectra, 'offsets', None) is not None:   # array-backed library, hash the flat peak arrays
+        for values in (spectra.mz, spectra.intensity):
+            digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(spectra.offsets, dtype=np.int64).tobytes())
+    else:
+        for spectrum in spectra:
+            digest.update(np.asarray(spectrum['mz'], dtype=np.float64).tobytes())
+            digest.update(np.asarray(spectrum['intensity'], dtype=np.float64).tobytes())
+            digest.update(len(spectrum['mz']).to_bytes(8, 'little'))
+    return digest.hexdigest()
 
 
+def run_checkpointed_identification(InputFilePaths, library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                                    minmatchedpeaks, fig_path, intensity_threshold=3000, lowerscan=0, higherscan=None,
+                                    generate_plots=False, n_workers=1, chunk_size=500, candidate_cache_size=256,
+                                    aggregate=None, aggregation_ppm=None, output_format='csv', excel_export=False,
+                                    batch_size=5000, plot_queue=None, preprocessing=None, progress_callback=None,
+                                    cancel=None):
+    """
+    Resumable version of run_identification with save, progress is recorded in a RunManifest in fig_path.
+    Every file is processed in chunks of chunk_size scans (or scan groups) and each chunk result is committed to disk,
+    the result file is assembled from the chunks once all of them are done. A restarted run skips files that are done
+    with the same content and parameters and only processes the chunks that are missing.
+    An error in one file is logged and recorded in the manifest and the run continues with the next file,
+    cancellation (see run_identification) stops the run after the last committed chunk.
+    Returns {input file path: result file path, None for failed files}.
+    Plots go to plot_queue, a default PlotQueue is used with generate_plots when none is given. The plot jobs are
+    committed with their chunk and queued in chunk order once the file is complete, so a resumed file gets the same
+    plots (and top_n selection) as an uninterrupted run.
+    """
+    if not isinstance(library, LibraryIndex):
+        library = LibraryIndex(library)
+    own_plot_queue = generate_plots and plot_queue is None
+    if own_plot_queue:
+        plot_queue = PlotQueue(fig_path)
+    manifest = RunManifest(fig_path)
+    library_hash = _library_fingerprint(library)
+    candidate_cache = CandidateCache(candidate_cache_size)
+    executor = None
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_identification_worker,
+                                       initargs=(library, candidate_cache_size, preprocessing))
+    results = {}
+    try:
+        for file_index, InputFilePath in enumerate(InputFilePaths):
+            try:
+                check_cancel(cancel)
+                content_hash = manifest.content_hash(InputFilePath)   # hashed again only when size or mtime changed
+                analyzer = QueryTargetedSpectrum(InputFilePath, intensity_threshold, candidate_cache=candidate_cache,
+                                                 preprocessing=preprocessing)
+                scan_range = (lowerscan, higherscan if higherscan is not None else analyzer.get_scans())
+                params = {'library': library_hash, 'PrecursorIonMassTolerance': PrecursorIonMassTolerance,
+                          'cosine_threshold': cosine_threshold, 'ppm_tolerance': ppm_tolerance,
+                          'minmatchedpeaks': minmatchedpeaks, 'intensity_threshold': intensity_threshold,
+                          'scan_range': list(scan_range), 'chunk_size': chunk_size, 'aggregate': aggregate,
+                          'aggregation_ppm': aggregation_ppm, 'output_format': output_format,
+                          'excel_export': excel_export, 'plots': plot_queue.params() if generate_plots else None}
+                if preprocessing is not None:
+                    params['preprocessing'] = preprocessing.params()   # unset for runs without, so that their checkpoints stay valid
+                if manifest.is_done(InputFilePath, params, content_hash):
+                    logging.info(f"Skipping {InputFilePath}, already identified")
+                    results[InputFilePath] = manifest.entry(InputFilePath)['result']
+                    progress = _file_progress(progress_callback, InputFilePath, scan_range[1] - scan_range[0],
+                                              file_index, len(InputFilePaths))
+                    if progress is not None:
+                        progress.done = progress.total
+                        progress.finish()
+                    continue
 
+                chunks = _file_chunks(InputFilePath, intensity_threshold, scan_range, chunk_size, aggregate)
+                done = manifest.start_file(InputFilePath, params, content_hash, len(chunks))
+                if done:
+                    logging.info(f"Resuming {InputFilePath}, {len(done)} of {len(chunks)} chunks already done")
+                pending = [chunk_id for chunk_id in range(len(chunks)) if chunk_id not in done]
+                progress = _file_progress(progress_callback, InputFilePath, sum(_chunk_scans(chunk) for chunk in chunks),
+                                          file_index, len(InputFilePaths))
+                if progress is not None:
+                    progress(sum(_chunk_scans(chunks[chunk_id]) for chunk_id in done))
+                chunk_args = (PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path)
+                if executor is None:
+                    for chunk_id in pending:
+                        lower, higher, scan_groups = chunks[chunk_id]
+                        plot_jobs = PlotJobList()
+                        result_dict = main_processing_function(
+                            lower, higher, analyzer, library, *chunk_args, generate_plots=generate_plots,
+                            aggregate=aggregate, aggregation_ppm=aggregation_ppm, scan_groups=scan_groups,
+                            plot_queue=plot_jobs, progress=progress, cancel=cancel)
+                        manifest.commit_chunk(InputFilePath, chunk_id, result_dict, plot_jobs)
+                else:
+                    futures = {executor.submit(_identify_scan_chunk, InputFilePath, intensity_threshold,
+                                               chunks[chunk_id][0], chunks[chunk_id][1], *chunk_args, generate_plots,
+                                               aggregate, aggregation_ppm, chunks[chunk_id][2]): chunk_id
+                               for chunk_id in pending}
+                    try:
+                        for future in as_completed(futures):
+                            manifest.commit_chunk(InputFilePath, futures[future], *future.result())
+                            if progress is not None:
+                                progress(_chunk_scans(chunks[futures[future]]))
+                            check_cancel(cancel)
+                    finally:
+                        for future in futures:
+                            future.cancel()
 
+                result_path = result_file_path(fig_path, InputFilePath, output_format)
+                with ResultWriter(result_path, output_format, batch_size=batch_size, columns=RESULT_COLUMNS,
+                                  excel_export=excel_export) as writer:
+                    for chunk_id in range(len(chunks)):
+                        result_dict, plot_jobs = manifest.read_chunk(InputFilePath, chunk_id)
+                        writer.write_rows(result_dict)
+                        if plot_queue is not None:
+                            for job in plot_jobs:
+                                plot_queue.submit(job)
+                manifest.finish_file(InputFilePath, result_path)
+                results[InputFilePath] = result_path
+                if progress is not None:
+                    progress.finish()
+            except RunCancelled:
+                raise
+            except Exception as e:
+                logging.error(f"Identification of {InputFilePath} failed: {e}")
+                manifest.fail_file(InputFilePath, e)
+                results[InputFilePath] = None
+            if plot_queue is not None:
+                plot_queue.finish_source(_file_label(InputFilePath))   # plots of a failed file come with its resumed run
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if own_plot_queue:
+            plot_queue.close()
+    return results
 
 
+def _open_writer(save, fig_path, InputFilePath, output_format, excel_export, batch_size):
+    if not save:
+        return None
+    return ResultWriter(result_file_path(fig_path, InputFilePath, output_format), output_format,
+                        batch_size=batch_size, columns=RESULT_COLUMNS, excel_export=excel_export)
@@ -0,0 +1,119 @@
+import os
+
+
+RESULT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'xlsx': '.xlsx'}
+
+
+def result_file_path(output_folder, input_file_path, output_format='csv') -> str:
+    """result file of an input file: <output folder>/<input file name up to the first dot>.<format>"""
+    file_label = os.path.basename(input_file_path).split('.')[0]
+    return os.path.join(output_folder, file_label + RESULT_FORMATS[output_format])
+
+
+class ResultWriter:
+    """
+    Streaming writer of identification results.
+    Rows arrive as column dicts (the result_dict of main_processing_function) and are buffered; every batch_size rows
+    the buffer is appended to the output file, so a crash only loses the current batch.
+    output_format is 'csv' or 'parquet' (needs pyarrow) for streaming, 'xlsx' is written once on close as
+    Excel cannot be appended to. With excel_export a .xlsx copy of a csv/parquet result is written on close.
+    """
+
+    def __init__(self, file_path, output_format='csv', batch_size=5000, columns=None, excel_export=False):
+        if output_format not in RESULT_FORMATS:
+            raise ValueError(f"Unsupported result format: {output_format}")
+        self.file_path = file_path
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.columns = list(columns) if columns is not None else None
+        self.excel_export = excel_export
+        self.rows_written = 0
+        self._buffer = None
+        self._buffered = 0
+        self._parquet_writer = None
+        self._frames = []   # xlsx only, written on close
+        # start from an empty file, rows of a previous run of the same input are replaced
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write_rows(self, result_dict):
+        """buffer the rows of a column dict, flushing whenever batch_size rows are buffered"""
+        if self.columns is None:
+            self.columns = list(result_dict)
+        if self._buffer is None:
+            self._buffer = {column: [] for column in self.columns}
+        added = len(result_dict[self.columns[0]]) if self.columns else 0
+        if not added:
+            return
+        for column in self.columns:
+            self._buffer[column].extend(result_dict[column])
+        self._buffered += added
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """append the buffered rows to the output file"""
+        if not self._buffered:
+            return
+        import pandas as pd
+        df = pd.DataFrame(self._buffer, columns=self.columns)
+        if self.output_format == 'csv':
+            df.to_csv(self.file_path, mode='a', header=self.rows_written == 0, index=False)
+        elif self.output_format == 'parquet':
+            self._write_parquet(df)
+        else:
+            self._frames.append(df)
+        self.rows_written += self._buffered
+        self._buffer = {column: [] for column in self.columns}
+        self._buffered = 0
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self._parquet_writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._parquet_writer = pq.ParquetWriter(self.file_path, table.schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._parquet_writer.schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """flush the remaining rows and finish the output file, an empty result still gets a file with the header"""
+        import pandas as pd
+        self.flush()
+        if self.output_format == 'parquet':
+            if self._parquet_writer is None:
+                pd.DataFrame(columns=self.columns).to_parquet(self.file_path, index=False)
+            else:
+                self._parquet_writer.close()
+                self._parquet_writer = None
+        elif self.output_format == 'csv':
+            if self.rows_written == 0:
+                pd.DataFrame(columns=self.columns).to_csv(self.file_path, index=False)
+        else:
+            df = pd.concat(self._frames) if self._frames else pd.DataFrame(columns=self.columns)
+            df.to_excel(self.file_path, index=False)
+            self._frames = []
+        if self.excel_export and self.output_format != 'xlsx':
+            read_result_file(self.file_path).to_excel(os.path.splitext(self.file_path)[0] + '.xlsx', index=False)
+
+
+def read_result_file(file_path, columns=None, dtype=None) -> 'pd.DataFrame':
+    """read a result file written by ResultWriter (or an older .xlsx result), optionally only the given columns,
+    dtype ({column: dtype}) skips the type inference of csv/xlsx"""
+    import pandas as pd
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(file_path, usecols=columns, dtype=dtype)
+    if extension == '.parquet':
+        df = pd.read_parquet(file_path, columns=columns)
+        return df.astype(dtype) if dtype is not None else df
+    if extension == '.xlsx':
+        return pd.read_excel(file_path, usecols=columns, dtype=dtype)
+    raise ValueError(f"Unsupported result file: {file_path}")
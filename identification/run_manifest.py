@@ -0,0 +1,141 @@
+import os
+import json
+import pickle
+import hashlib
+import shutil
+
+
+MANIFEST_FILENAME = 'dimeta_run.json'
+CHECKPOINT_FOLDER = '.dimeta_checkpoints'
+
+
+def file_content_hash(file_path, block_size=1 << 20) -> str:
+    """sha256 of the file content"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def params_hash(params) -> str:
+    """sha256 of the JSON form of a parameter dict, keys sorted"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _atomic_write(file_path, data):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, file_path)
+
+
+class RunManifest:
+    """
+    Record of a batch identification run kept in the output folder (dimeta_run.json), so that a restarted run skips
+    input files that are done and resumes partially processed files from their last committed chunk.
+    Every input file is recorded with its parameters, the hash of its content (with the size and modification time it
+    was taken at) and of the parameters, its status
+    ('running', 'done' or 'failed'), the committed chunks and the result file. Chunk results are pickled result dicts
+    together with the plot jobs of the chunk under .dimeta_checkpoints/, written under a temporary name and moved into
+    place, as is the manifest itself.
+    A changed input file or changed parameters invalidate the record and its chunks.
+    """
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_FILENAME)
+        self.data = {'version': 1, 'files': {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    self.data = json.load(file)
+            except (OSError, ValueError):
+                pass   # unreadable manifest, start over
+
+    def save(self):
+        _atomic_write(self.path, json.dumps(self.data, indent=1).encode('utf-8'))
+
+    def entry(self, input_file_path) -> dict:
+        return self.data['files'].get(input_file_path)
+
+    def content_hash(self, input_file_path) -> str:
+        """content hash of an input file, the recorded one while its size and modification time are unchanged"""
+        stat = os.stat(input_file_path)
+        entry = self.entry(input_file_path)
+        if entry is not None and entry.get('content_hash') and entry.get('size') == stat.st_size \
+                and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return entry['content_hash']
+        content_hash = file_content_hash(input_file_path)
+        if entry is not None and entry.get('content_hash') == content_hash:   # touched but unchanged, not hashed again
+            entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            self.save()
+        return content_hash
+
+    def start_file(self, input_file_path, params, content_hash, n_chunks) -> set:
+        """
+        Register an input file before processing, returns the ids of chunks already committed for the same
+        content and parameters (all of them are dropped when either changed).
+        """
+        key = params_hash(params)
+        entry = self.entry(input_file_path)
+        if entry is None or entry.get('content_hash') != content_hash or entry.get('params_hash') != key \
+                or entry.get('n_chunks') != n_chunks:
+            self.clear_chunks(input_file_path)
+            entry = {'params': params, 'params_hash': key, 'content_hash': content_hash, 'n_chunks': n_chunks,
+                     'chunks_done': [], 'status': 'running', 'result': None, 'error': None}
+            self.data['files'][input_file_path] = entry
+        elif entry['status'] == 'failed':
+            entry['status'], entry['error'] = 'running', None
+        stat = os.stat(input_file_path)
+        entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        self.save()
+        return {chunk_id for chunk_id in entry['chunks_done'] if os.path.exists(self.chunk_path(input_file_path, chunk_id))}
+
+    def is_done(self, input_file_path, params, content_hash) -> bool:
+        entry = self.entry(input_file_path)
+        return (entry is not None and entry['status'] == 'done' and entry['content_hash'] == content_hash
+                and entry['params_hash'] == params_hash(params) and entry['result'] is not None
+                and os.path.exists(entry['result']))
+
+    def chunk_folder(self, input_file_path) -> str:
+        label = hashlib.sha256(input_file_path.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.output_folder, CHECKPOINT_FOLDER, label)
+
+    def chunk_path(self, input_file_path, chunk_id) -> str:
+        return os.path.join(self.chunk_folder(input_file_path), f'chunk_{chunk_id:06d}.pkl')
+
+    def commit_chunk(self, input_file_path, chunk_id, result_dict, plot_jobs=()):
+        """store the result and the plot jobs of a chunk and record it as done"""
+        os.makedirs(self.chunk_folder(input_file_path), exist_ok=True)
+        _atomic_write(self.chunk_path(input_file_path, chunk_id),
+                      pickle.dumps({'rows': result_dict, 'plots': list(plot_jobs)}, protocol=pickle.HIGHEST_PROTOCOL))
+        entry = self.data['files'][input_file_path]
+        if chunk_id not in entry['chunks_done']:
+            entry['chunks_done'].append(chunk_id)
+        self.save()
+
+    def read_chunk(self, input_file_path, chunk_id) -> tuple:
+        """(result dict, plot jobs) of a committed chunk"""
+        with open(self.chunk_path(input_file_path, chunk_id), 'rb') as file:
+            chunk = pickle.load(file)
+        return chunk['rows'], chunk['plots']
+
+    def clear_chunks(self, input_file_path):
+        shutil.rmtree(self.chunk_folder(input_file_path), ignore_errors=True)
+
+    def finish_file(self, input_file_path, result_path):
+        """mark the file done, its chunk results are no longer needed once the result file is complete"""
+        entry = self.data['files'][input_file_path]
+        entry['status'], entry['result'], entry['error'] = 'done', result_path, None
+        self.save()
+        self.clear_chunks(input_file_path)
+
+    def fail_file(self, input_file_path, error):
+        entry = self.data['files'].get(input_file_path)
+        if entry is None:
+            entry = {'chunks_done': [], 'params': None, 'params_hash': None, 'content_hash': None, 'n_chunks': None,
+                     'result': None}
+            self.data['files'][input_file_path] = entry
+        entry['status'], entry['error'] = 'failed', str(error)
+        self.save()